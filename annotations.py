@@ -17,10 +17,20 @@
 #######################################################################
 #!/usr/bin/python
 import os
-import copy
-import pandas as pd
+import csv
+import json
+import re
 import inspect
+import struct
 import sys
+import zipfile
+
+import numpy as np
+
+import utils
+
+BUFFER_SIZE = 1000
+ANNOTATIONS_NAME = "annotations"
 
 class AnnotatorFactory(object):
     """Factory class for annotators"""
@@ -33,57 +43,193 @@ class AnnotatorFactory(object):
         return annotator
 
 
+    @staticmethod
+    def get_prefixes():
+        """Returns the prefix of every annotator implementation, i.e: tf"""
+        suffix = len("Annotator")
+        return [annotator.__name__[:-suffix].lower() for annotator in Annotator.__subclasses__()]
+
+
 class Annotator(object):
-    """Defines a generic annotator for plates bounding boxes"""
+    """Defines a generic annotator for plates bounding boxes
+        Annotations are buffered and streamed to disk once the annotation file is opened
+    """
 
-    def __init__(self):
+    def __init__(self, buffer_size=BUFFER_SIZE):
         self.annotations = None
+        self.buffer_size = buffer_size
+        self.output_file = None
+        self.extension = None
+        self.shard_index = 0
+        self.shard_count = 1
+        self.fsync = False
 
 
     def get_annotation(self, plate):
         raise NotImplementedError()
 
-    
-    def save_annotations(self, output_path):
+
+    def get_annotations(self, plate):
+        """Returns the annotations of an image, a single one unless the annotator writes one per plate of a scene"""
+        return [self.get_annotation(plate)]
+
+
+    def open_writer(self):
+        pass
+
+
+    def write_header(self):
+        pass
+
+
+    def write_annotations(self, annotations):
+        raise NotImplementedError()
+
+
+    def write_footer(self):
+        pass
+
+
+    def read_annotations(self, path):
+        """Yields the annotations of a file written by this annotator"""
         raise NotImplementedError()
 
 
+    def get_output_file(self, output_path):
+        """Returns the annotation file, nodes of a sharded run write their own file"""
+        return os.path.join(output_path, utils.get_node_filename(ANNOTATIONS_NAME, self.extension, self.shard_index, self.shard_count))
+
+
+    def get_stream_file(self, output_path):
+        """Returns the file annotations are streamed to as they are added, the annotation file itself by default"""
+        return self.get_output_file(output_path)
+
+
+    def get_shard_files(self, path):
+        """Returns the annotation files of every node of a sharded run found on a directory, by shard index"""
+        pattern = re.compile(r"^{0}-(\d+)-of-(\d+)\.{1}$".format(ANNOTATIONS_NAME, re.escape(self.extension)))
+        shard_files = {}
+        shard_counts = set()
+        for filename in os.listdir(path):
+            match = pattern.match(filename)
+            if match:
+                shard_files[int(match.group(1))] = os.path.join(path, filename)
+                shard_counts.add(int(match.group(2)))
+        if len(shard_counts) != 1:
+            raise ValueError("Expected annotation files of a single sharded run on {0}, found shard counts: {1}".format(path, sorted(shard_counts)))
+        shard_count = shard_counts.pop()
+        missing = sorted(set(range(shard_count)).difference(shard_files))
+        if missing:
+            raise ValueError("Missing annotation files of shards {0} out of {1}".format(missing, shard_count))
+        return [shard_files[index] for index in range(shard_count)]
+
+
+    def merge_annotations(self, input_files, output_path):
+        """Writes the annotations of several files as a single annotation set, in the order of the files"""
+        self.open_annotations(output_path)
+        for input_file in input_files:
+            self.add_annotations(self.read_annotations(input_file))
+        self.save_annotations(output_path)
+
+
+    def open_annotations(self, output_path, offset=None):
+        """Opens the annotation file, from now on annotations are written as they are added
+            Resumes an existing file if an offset is given, anything written after it is discarded
+        """
+        if offset is None:
+            self.output_file = open(self.get_stream_file(output_path), 'w', newline='')
+            self.open_writer()
+            self.write_header()
+        else:
+            self.output_file = open(self.get_stream_file(output_path), 'r+', newline='')
+            self.output_file.truncate(offset)
+            self.output_file.seek(offset)
+            self.open_writer()
+
+
+    def get_offset(self):
+        """Flushes buffered annotations and returns the size of the annotation file"""
+        self.flush_annotations()
+        if self.fsync:
+            utils.sync_file(self.output_file)
+        return self.output_file.tell()
+
+
+    def flush_annotations(self):
+        """Writes buffered annotations to disk"""
+        self.write_annotations(self.annotations)
+        self.output_file.flush()
+        self.annotations = []
+
+
+    def save_annotations(self, output_path):
+        """Writes any pending annotations and closes the annotation file"""
+        if self.output_file is None:
+            self.open_annotations(output_path)
+        self.flush_annotations()
+        self.write_footer()
+        if self.fsync:
+            utils.sync_file(self.output_file)
+        self.output_file.close()
+        self.output_file = None
+
+
     def append_annotation(self, plate):
-        new_anotation = self.get_annotation(plate)
-        self.annotations.append(new_anotation)
+        self.add_annotations(self.get_annotations(plate))
+
+
+    def add_annotation(self, annotation):
+        """Adds an already generated annotation, i.e: one returned by a worker process"""
+        self.annotations.append(annotation)
+        if self.output_file is not None and len(self.annotations) >= self.buffer_size:
+            self.flush_annotations()
+
+
+    def add_annotations(self, annotations):
+        for annotation in annotations:
+            self.add_annotation(annotation)
 
 
 class JSONAnnotator(Annotator):
-    """Annotator implementation for original JSON format
+    """Annotator implementation for original JSON format, written as JSON Lines (one image per line)
         Bounding box format: cx, cy, w, h, angle
+        Images of several plates hold a plates list instead, the class and bboxes of each plate
     """
 
     def __init__(self):
         super(JSONAnnotator, self).__init__()
         self.plate_annotation = {'filename': None, 'class': None, 'bboxes': []}
-        self.bbox_annotation = {'class': None, 'cx': None, 'cy': None, 'w': None, 'h': None, 'angle': 0}
         self.annotations = []
-        self.extension = "json"
+        self.extension = "jsonl"
 
 
     def get_annotation(self, plate):
-        annotation = copy.copy(self.plate_annotation)
+        if plate.get_plates() != [plate]:
+            return plate.get_annotation()
+
+        annotation = dict(self.plate_annotation)
         annotation['filename'] = plate.get_filename()
         annotation['class'] = plate.type
-
-        for bbox in plate.bounding_boxes:
-            annotation['bboxes'].append(copy.copy(bbox))
+        annotation['bboxes'] = plate.bounding_boxes.to_dicts()
 
         return annotation
 
 
-    def save_annotations(self, output_path):
-        with open(output_path, 'w') as f:
-            f.write(str(self.annotations))
+    def write_annotations(self, annotations):
+        for annotation in annotations:
+            self.output_file.write(json.dumps(annotation))
+            self.output_file.write('\n')
+
+
+    def read_annotations(self, path):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
 
 
 class TFAnnotator(Annotator):
-    """Annotator implementation for Tensorflow .csv format
+    """Annotator implementation for Tensorflow .csv format, one row per plate of an image
         Format: filename, img_width, img_height, class, xmin, ymin, xmax, ymax
     """
        
@@ -93,14 +239,25 @@ class TFAnnotator(Annotator):
             'class', 'xmin', 'ymin', 'xmax', 'ymax']
         self.annotations = []
         self.extension = "csv"
+        self.writer = None
 
 
     def get_annotation(self, plate):
-        plate_bbox = plate.bounding_boxes[-1] # Last bbox is plate bbox
+        return self.get_plate_row(plate, plate)
+
+
+    def get_annotations(self, plate):
+        # One row per plate of a scene
+        return [self.get_plate_row(plate, scene_plate) for scene_plate in plate.get_plates()]
+
+
+    def get_plate_row(self, image, plate):
+        """Returns the row of a plate shown on an image"""
+        plate_bbox = plate.bounding_boxes.to_dict(-1) # Last bbox is plate bbox
         annotation = (
-            plate.get_filename(), # filename
-            plate.image_data.shape[1], # width
-            plate.image_data.shape[0], # height
+            image.get_filename(), # filename
+            image.image_data.shape[1], # width
+            image.image_data.shape[0], # height
             plate.type, # class
             plate_bbox['cx'] - (plate_bbox['w'] / 2), # xmin
             plate_bbox['cy'] - (plate_bbox['h'] / 2), # ymin
@@ -110,10 +267,178 @@ class TFAnnotator(Annotator):
 
         return annotation
 
-    
+
+    def open_writer(self):
+        self.writer = csv.writer(self.output_file, lineterminator='\n')
+
+
+    def write_header(self):
+        self.writer.writerow(self.columns)
+
+
+    def write_annotations(self, annotations):
+        self.writer.writerows(annotations)
+
+
+    def read_annotations(self, path):
+        # Values are kept as written, so they are merged without any loss
+        with open(path, newline='') as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                yield tuple(row)
+
+
+
+class NPZAnnotator(Annotator):
+    """Annotator implementation for a columnar NumPy .npz file, every image, plate and character box as flat arrays
+        Image columns: filename, width, height
+        Plate columns: image_id, plate_class and offsets, boxes of plate i are offsets[i]:offsets[i + 1]
+        Box columns: plate_id, class, cx, cy, w, h, angle. Classes are indexes into class_names
+        Annotations are streamed to a JSON Lines file next to it, the .npz is built from it once saved
+    """
+
+    BOX_COLUMNS = ['cx', 'cy', 'w', 'h', 'angle']
+
+    def __init__(self):
+        super(NPZAnnotator, self).__init__()
+        self.annotations = []
+        self.extension = "npz"
+
+
+    def get_annotation(self, plate):
+        annotation = (
+            plate.get_filename(), # filename
+            plate.image_data.shape[1], # width
+            plate.image_data.shape[0], # height
+            [self.get_plate_boxes(scene_plate) for scene_plate in plate.get_plates()] # boxes of every plate of the image
+        )
+
+        return annotation
+
+
+    def get_plate_boxes(self, plate):
+        """Returns the class of a plate, the class and the cx, cy, w, h, angle of every box of it"""
+        bounding_boxes = plate.bounding_boxes
+        return (plate.type, bounding_boxes.classes.tolist(), bounding_boxes.boxes.tolist())
+
+
+    def get_stream_file(self, output_path):
+        return "{0}.jsonl".format(self.get_output_file(output_path))
+
+
+    def write_annotations(self, annotations):
+        for annotation in annotations:
+            self.output_file.write(json.dumps(annotation))
+            self.output_file.write('\n')
+
+
     def save_annotations(self, output_path):
-        dataframe = pd.DataFrame(self.annotations, columns=self.columns)
-        output_file = os.path.join(output_path, "annotations.{0}".format(self.extension))
-        dataframe.to_csv(output_file, index=None)
+        super(NPZAnnotator, self).save_annotations(output_path)
+        self.write_columns(self.get_stream_file(output_path), self.get_output_file(output_path))
+
+
+    def write_columns(self, stream_file, output_file):
+        """Builds the .npz columns of every annotation streamed to a file
+            Stored uncompressed, so columns can be memory-mapped, see load_columns
+        """
+        filenames, widths, heights, image_ids = [], [], [], []
+        plate_classes, counts, box_classes, boxes = [], [], [], []
+        with open(stream_file) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                filename, width, height, plates = json.loads(line)
+                for plate_class, classes, plate_boxes in plates:
+                    image_ids.append(len(filenames))
+                    plate_classes.append(plate_class)
+                    counts.append(len(classes))
+                    box_classes.extend(classes)
+                    boxes.append(np.array(plate_boxes, dtype=np.float32).reshape(-1, len(self.BOX_COLUMNS)))
+                filenames.append(filename)
+                widths.append(width)
+                heights.append(height)
+
+        class_names = sorted(set(plate_classes).union(box_classes))
+        class_ids = dict((name, index) for index, name in enumerate(class_names))
+        boxes = np.concatenate(boxes) if boxes else np.empty((0, len(self.BOX_COLUMNS)), dtype=np.float32)
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        columns = {
+            'filename': np.array(filenames, dtype=str),
+            'width': np.array(widths, dtype=np.int32),
+            'height': np.array(heights, dtype=np.int32),
+            'image_id': np.array(image_ids, dtype=np.int64),
+            'plate_class': np.array([class_ids[name] for name in plate_classes], dtype=np.int32),
+            'offsets': offsets,
+            'plate_id': np.repeat(np.arange(len(counts), dtype=np.int64), counts),
+            'class': np.array([class_ids[name] for name in box_classes], dtype=np.int32),
+            'class_names': np.array(class_names, dtype=str)
+        }
+        for index, column in enumerate(self.BOX_COLUMNS):
+            columns[column] = np.ascontiguousarray(boxes[:, index])
+
+        # Written to a temporary file first, an interrupted save leaves the previous file as it was
+        temp_file = "{0}.tmp".format(output_file)
+        with open(temp_file, 'wb') as f:
+            np.savez(f, **columns)
+            if self.fsync:
+                utils.sync_file(f)
+        os.replace(temp_file, output_file)
 
 
+    def read_annotations(self, path):
+        columns = load_columns(path)
+        class_names = columns['class_names'].tolist()
+        boxes = np.stack([columns[column] for column in self.BOX_COLUMNS], axis=1)
+        offsets = columns['offsets']
+        plate_offsets = get_plate_offsets(columns)
+        for index, filename in enumerate(columns['filename'].tolist()):
+            plates = []
+            for plate_id in range(plate_offsets[index], plate_offsets[index + 1]):
+                start, end = offsets[plate_id], offsets[plate_id + 1]
+                plates.append((
+                    class_names[columns['plate_class'][plate_id]],
+                    [class_names[class_id] for class_id in columns['class'][start:end]],
+                    boxes[start:end].tolist()
+                ))
+            yield (
+                filename,
+                int(columns['width'][index]),
+                int(columns['height'][index]),
+                plates
+            )
+
+
+def get_plate_offsets(columns):
+    """Returns the plate offsets of every image of .npz columns, plates of image i are plate_offsets[i]:plate_offsets[i + 1]"""
+    return np.searchsorted(columns['image_id'], np.arange(len(columns['filename']) + 1))
+
+
+def load_columns(path, mmap_mode=None):
+    """Returns the columns of an .npz annotation file by name, memory-mapped if an mmap_mode ('r', 'c') is given
+        np.load does not memory-map .npz members, as they are stored uncompressed each one is mapped at its offset
+    """
+    if mmap_mode is None:
+        with np.load(path) as data:
+            return dict((name, data[name]) for name in data.files)
+
+    columns = {}
+    with zipfile.ZipFile(path) as archive, open(path, 'rb') as f:
+        for info in archive.infolist():
+            # Array data follows the local file header, its name, extra field and the .npy header
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack('<HH', f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            name = os.path.splitext(info.filename)[0]
+            if not shape or 0 in shape:
+                columns[name] = np.zeros(shape, dtype=dtype)
+            else:
+                columns[name] = np.memmap(path, dtype=dtype, mode=mmap_mode, shape=shape,
+                    order='F' if fortran_order else 'C', offset=f.tell())
+    return columns
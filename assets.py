@@ -0,0 +1,401 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import os
+import math
+import hashlib
+import random
+import string
+import numpy as np
+import PIL.Image, PIL.ImageFont, PIL.ImageDraw, PIL.ImageColor
+
+import utils
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+# Sub-pixel positions FreeType can render a glyph at, per pixel
+GLYPH_SUBPIXELS = 64
+
+
+class AssetRegistry(object):
+    """Holds decoded base images and loaded fonts used to render plates"""
+
+    def __init__(self, context):
+        self.context = context
+        self.templates_path = context.settings.general.templates_path
+        self.bbox_padding = context.settings.image.bbox_padding
+        self.pyramid_path = context.settings.image.pyramid_cache_path
+        self.images = {}
+        self.arrays = {}
+        self.hashes = {}
+        self.fonts = {}
+        self.glyphs = {}
+        self.inks = {}
+        self.samplers = {}
+
+
+    def preload(self, templates):
+        """Decodes every base image and loads every font/size pair found on templates"""
+        for template in templates.values():
+            for base_file in template["base-image"]:
+                self.load_image(base_file)
+            text_templates = template["plate-number"] + template.get("extra-text", [])
+            for text_template in text_templates:
+                self.get_font(text_template["font"], text_template["size"])
+                for char in get_regex_alphabet(text_template["regex"]):
+                    self.get_glyph(text_template["font"], text_template["size"], char)
+                self.get_ink(text_template["color"])
+                self.get_sampler(text_template["regex"])
+
+
+    def load_image(self, base_file):
+        """Returns the shared decoded base image, loading it on first use"""
+        image = self.images.get(base_file)
+        if image is None:
+            image = PIL.Image.open(os.path.join(self.templates_path, base_file))
+            image.load()
+            self.images[base_file] = image
+        return image
+
+
+    def get_image_array(self, base_file, scale_factor=1):
+        """Returns a copy of a base image as a BGR array scaled by a factor, safe to draw on"""
+        return self.get_shared_array(base_file, scale_factor).copy()
+
+
+    def get_shared_array(self, base_file, scale_factor=1):
+        """Returns the shared BGR array of a base image scaled by a factor, must not be modified"""
+        key = (base_file, scale_factor)
+        array = self.arrays.get(key)
+        if array is None:
+            if scale_factor == 1:
+                array = np.ascontiguousarray(np.asarray(self.load_image(base_file).convert("RGB"))[:, :, ::-1])
+            else:
+                array = self.load_level(base_file, scale_factor)
+            self.arrays[key] = array
+        return array
+
+
+    def preload_levels(self, scale_factors):
+        """Builds the pyramid of every loaded base image, one BGR level per scale factor"""
+        for base_file in list(self.images):
+            for scale_factor in scale_factors:
+                self.get_shared_array(base_file, scale_factor)
+
+
+    def load_level(self, base_file, scale_factor):
+        """Returns a base image scaled by a factor, read from the pyramid cache on disk when configured
+            Cached levels are keyed by the hash of the base image file and the scale factor
+        """
+        if not self.pyramid_path:
+            return utils.rescale_image(self.get_shared_array(base_file), scale_factor)
+
+        level_file = os.path.join(self.pyramid_path, "{0}-{1}.npy".format(self.get_file_hash(base_file), scale_factor))
+        if os.path.exists(level_file):
+            return np.load(level_file)
+
+        level = utils.rescale_image(self.get_shared_array(base_file), scale_factor)
+        if not os.path.exists(self.pyramid_path):
+            os.makedirs(self.pyramid_path, exist_ok=True)
+        # Written to a temporary file first, concurrent runs never read a partial level
+        temp_file = "{0}.{1}.tmp".format(level_file, os.getpid())
+        with open(temp_file, 'wb') as f:
+            np.save(f, level)
+        os.replace(temp_file, level_file)
+        return level
+
+
+    def get_file_hash(self, base_file):
+        """Returns the SHA-1 of a base image file"""
+        file_hash = self.hashes.get(base_file)
+        if file_hash is None:
+            with open(os.path.join(self.templates_path, base_file), 'rb') as f:
+                file_hash = hashlib.sha1(f.read()).hexdigest()
+            self.hashes[base_file] = file_hash
+        return file_hash
+
+
+    def get_image_sizes(self):
+        """Returns the distinct (width, height) sizes of loaded base images"""
+        return sorted(set(image.size for image in self.images.values()))
+
+
+    def get_scaled_sizes(self, scale_factors):
+        """Returns the distinct (width, height) sizes of loaded base images after scaling"""
+        sizes = set()
+        for width, height in self.get_image_sizes():
+            for scale_factor in scale_factors:
+                sizes.add(utils.get_scaled_size(width, height, scale_factor))
+        return sorted(sizes)
+
+
+    def get_font(self, font_file, size):
+        """Returns a loaded font for a font/size pair"""
+        key = (font_file, size)
+        font = self.fonts.get(key)
+        if font is None:
+            font = PIL.ImageFont.truetype(os.path.join(self.templates_path, font_file), size)
+            self.fonts[key] = font
+        return font
+
+
+    def get_glyph(self, font_file, size, char, position=(0, 0)):
+        """Returns the rasterized glyph of a character, for the sub-pixel start of a drawing position
+            FreeType positions glyphs on a 1/64 px grid, starts are rounded to it so the same glyphs share a key
+        """
+        start = tuple(round(math.modf(coordinate)[0] * GLYPH_SUBPIXELS) / GLYPH_SUBPIXELS for coordinate in position)
+        key = (font_file, size, char, start)
+        glyph = self.glyphs.get(key)
+        if glyph is None:
+            glyph = Glyph(self.get_font(font_file, size), char, start)
+            self.glyphs[key] = glyph
+        return glyph
+
+
+    def get_ink(self, color):
+        """Returns a color string as a BGR array ready to blend glyphs"""
+        ink = self.inks.get(color)
+        if ink is None:
+            ink = np.array(PIL.ImageColor.getrgb(color)[2::-1], dtype=np.uint16)
+            self.inks[color] = ink
+        return ink
+
+
+    def get_sampler(self, regex):
+        """Returns the compiled sampler of a template regex"""
+        sampler = self.samplers.get(regex)
+        if sampler is None:
+            sampler = RegexSampler(regex)
+            self.samplers[regex] = sampler
+        return sampler
+
+
+class Glyph(object):
+    """Character rasterized once: alpha mask, its offset from the drawing position and font metrics"""
+
+    def __init__(self, font, char, start=(0, 0)):
+        # Same metrics as font.getsize: (width, baseline), (offset_x, offset_y)
+        self.size, self.offset = font.font.getsize(char)
+
+        # Draw on a blank canvas with enough padding, PIL positions and antialiases it exactly as on a plate
+        padding = int(math.ceil(font.size))
+        left, top, right, bottom = font.getbbox(char)
+        canvas = PIL.Image.new("L", (right - min(left, 0) + 2*padding, bottom - min(top, 0) + 2*padding), 0)
+        PIL.ImageDraw.Draw(canvas).text((padding + start[0], padding + start[1]), char, font=font, fill=255)
+        bbox = canvas.getbbox()
+        if bbox is None:
+            bbox = (padding, padding, padding, padding)
+        self.mask = np.asarray(canvas.crop(bbox)).astype(np.uint16)[:, :, np.newaxis]
+        self.mask_offset = (bbox[0] - padding, bbox[1] - padding)
+
+
+    def get_metrics(self):
+        """Returns (width, baseline), (offset_x, offset_y) as font.getsize"""
+        return self.size, self.offset
+
+
+    def get_region(self, position, width, height):
+        """Returns the (x1, y1, x2, y2) region of an image covered at a drawing position and the mask slice over it
+            None if the glyph falls outside of the image
+        """
+        x1 = int(position[0]) + self.mask_offset[0]
+        y1 = int(position[1]) + self.mask_offset[1]
+        x2 = x1 + self.mask.shape[1]
+        y2 = y1 + self.mask.shape[0]
+
+        # Clip to image boundaries
+        mx1, my1 = max(0, -x1), max(0, -y1)
+        mx2 = self.mask.shape[1] - max(0, x2 - width)
+        my2 = self.mask.shape[0] - max(0, y2 - height)
+        if mx2 <= mx1 or my2 <= my1:
+            return None
+        region = (x1 + mx1, y1 + my1, x1 + mx2, y1 + my2)
+        return region, self.mask[my1:my2, mx1:mx2]
+
+
+    def draw(self, image, position, ink):
+        """Blends glyph on a BGR array with an ink color of the same layout, same result as PIL.ImageDraw.text"""
+        clip = self.get_region(position, image.shape[1], image.shape[0])
+        if clip is None:
+            return
+        (x1, y1, x2, y2), mask = clip
+        blend_mask(image[y1:y2, x1:x2], mask, ink)
+
+
+def blend_mask(roi, mask, ink):
+    """Blends an ink color on an image region through an alpha mask, in place"""
+    # PIL blending: DIV255(image * (255 - mask) + ink * mask), rounded
+    blend = roi * (255 - mask)
+    blend += ink * mask
+    blend += 128
+    blend += blend >> 8
+    blend >>= 8
+    roi[...] = blend
+
+
+class RegexSampler(object):
+    """Regex parsed once into a list of sampling operations, draws random strings the regex matches
+        Draws consume the random generator as rstr.xeger does, so a seeded run gives the same text.
+        size is the number of distinct strings it can draw, None if unbounded or unknown.
+    """
+
+    # Same upper bound rstr uses for * and + repeats
+    REPEAT_LIMIT = 100
+
+    def __init__(self, regex):
+        self.regex = regex
+        self.operations = self.compile(sre_parse.parse(regex))
+        self.size = self.get_size(self.operations)
+
+
+    def compile(self, parsed):
+        """Converts a parsed regex into (operation, value) tuples, consecutive literals are merged"""
+        operations = []
+        for opcode, value in parsed:
+            if opcode == sre_parse.LITERAL:
+                if operations and operations[-1][0] == 'text':
+                    operations[-1] = ('text', operations[-1][1] + chr(value))
+                else:
+                    operations.append(('text', chr(value)))
+            elif opcode == sre_parse.IN:
+                operations.append(('choice', get_set_alphabet(value)))
+            elif opcode == sre_parse.ANY:
+                operations.append(('choice', string.printable.replace('\n', '')))
+            elif opcode == sre_parse.NOT_LITERAL:
+                operations.append(('choice', string.printable.replace(chr(value), '')))
+            elif opcode in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+                start, end, repeated = value
+                operations.append(('repeat', (start, min(end, self.REPEAT_LIMIT), self.compile(repeated))))
+            elif opcode == sre_parse.BRANCH:
+                operations.append(('branch', [self.compile(branch) for branch in value[1]]))
+            elif opcode == sre_parse.SUBPATTERN:
+                operations.append(('group', (value[0], self.compile(value[-1]))))
+            elif opcode == sre_parse.GROUPREF:
+                operations.append(('groupref', value))
+            elif opcode == sre_parse.ASSERT:
+                operations.extend(self.compile(value[1]))
+            elif opcode not in (sre_parse.AT, sre_parse.ASSERT_NOT):
+                raise ValueError("Unsupported regex {0!r}: {1}".format(self.regex, opcode))
+        return operations
+
+
+    def get_size(self, operations):
+        size = 1
+        for operation, value in operations:
+            if operation == 'choice':
+                size *= len(value)
+            elif operation == 'repeat':
+                start, end, repeated = value
+                repeated_size = self.get_size(repeated)
+                if repeated_size is None:
+                    return None
+                size *= sum(repeated_size ** times for times in range(start, end + 1))
+            elif operation == 'branch':
+                sizes = [self.get_size(branch) for branch in value]
+                if None in sizes:
+                    return None
+                size *= sum(sizes)
+            elif operation == 'group':
+                group_size = self.get_size(value[1])
+                if group_size is None:
+                    return None
+                size *= group_size
+        return size
+
+
+    def sample(self, rng=random):
+        """Draws a random string, rng is the module random or a random.Random instance"""
+        groups = {}
+        return self.build(self.operations, rng, groups)
+
+
+    def build(self, operations, rng, groups):
+        result = []
+        for operation, value in operations:
+            if operation == 'text':
+                result.append(value)
+            elif operation == 'choice':
+                result.append(rng.choice(value))
+            elif operation == 'repeat':
+                start, end, repeated = value
+                for _ in range(rng.randint(start, end)):
+                    result.append(self.build(repeated, rng, groups))
+            elif operation == 'branch':
+                result.append(self.build(rng.choice(value), rng, groups))
+            elif operation == 'group':
+                text = self.build(value[1], rng, groups)
+                if value[0]:
+                    groups[value[0]] = text
+                result.append(text)
+            else:
+                result.append(groups[value])
+        return ''.join(result)
+
+
+def get_set_alphabet(items):
+    """Returns the characters of a regex set in the order rstr picks them from, negated sets are sorted"""
+    alphabet = []
+    negate = False
+    for opcode, value in items:
+        if opcode == sre_parse.NEGATE:
+            negate = True
+        elif opcode == sre_parse.LITERAL:
+            alphabet.append(chr(value))
+        elif opcode == sre_parse.RANGE:
+            alphabet.extend(chr(code) for code in range(value[0], value[1] + 1))
+        elif opcode == sre_parse.CATEGORY:
+            alphabet.extend(CATEGORY_ALPHABETS[value])
+    if negate:
+        alphabet = sorted(set(string.printable).difference(alphabet))
+    return ''.join(alphabet)
+
+
+CATEGORY_ALPHABETS = {
+    sre_parse.CATEGORY_DIGIT: string.digits,
+    sre_parse.CATEGORY_NOT_DIGIT: string.ascii_letters + string.punctuation,
+    sre_parse.CATEGORY_SPACE: string.whitespace,
+    sre_parse.CATEGORY_NOT_SPACE: string.printable.strip(),
+    sre_parse.CATEGORY_WORD: string.ascii_letters + string.digits + '_',
+    sre_parse.CATEGORY_NOT_WORD: ''.join(sorted(set(string.printable).difference(string.ascii_letters + string.digits + '_')))
+}
+
+
+def get_regex_alphabet(regex):
+    """Returns the set of characters a regex can produce, literals and character sets only"""
+    alphabet = set()
+    pending = list(sre_parse.parse(regex))
+    while pending:
+        opcode, value = pending.pop()
+        if opcode == sre_parse.LITERAL:
+            alphabet.add(chr(value))
+        elif opcode == sre_parse.RANGE:
+            alphabet.update(chr(code) for code in range(value[0], value[1] + 1))
+        elif opcode == sre_parse.IN:
+            pending.extend(value)
+        elif opcode in (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT):
+            pending.extend(value[2])
+        elif opcode == sre_parse.SUBPATTERN:
+            pending.extend(value[-1])
+        elif opcode == sre_parse.BRANCH:
+            for branch in value[1]:
+                pending.extend(branch)
+    return alphabet
@@ -0,0 +1,190 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+
+import plate
+import assets
+import bboxes
+import perspective
+import profiler
+import scene
+import utils
+
+# Random choices of a plate, drawn in the same order as generator.generate_plate draws them
+PlatePlan = namedtuple('PlatePlan', ['plate_type', 'base_file', 'plate_number', 'texts', 'scale_factor', 'angles', 'background', 'position'])
+
+
+class BatchRenderer(object):
+    """Renders plates in batches grouped by (template, base image, scale), same result as rendering them one by one
+        Plates of a group are drawn on a stacked BGR array of their base image. A glyph drawn at the same place over
+        the same base image is blended once, the resulting tile is copied to every plate that uses it.
+        With render_at_scale groups are drawn on the base image already scaled and are not resized afterwards.
+    """
+
+    def __init__(self, context, templates, registry, workers=1):
+        self.context = context
+        self.templates = templates
+        self.registry = registry
+        self.tiles = OrderedDict()
+        self.used_bytes = 0
+        # tile_cache_size is the budget of all worker processes
+        self.max_bytes = int(context.settings.image.tile_cache_size * 1024 * 1024 / workers)
+
+
+    def generate(self, assignments, bg_cache, warp_cache=None, run_profiler=profiler.DISABLED):
+        """Generates a batch of plates from (plate_type, number_template, plate_number) assignments, in order, None ones are drawn at random"""
+        with run_profiler.stage('plan'):
+            plans = [self.plan(assignment, bg_cache, warp_cache) for assignment in assignments]
+
+        groups = OrderedDict()
+        for index, plan in enumerate(plans):
+            groups.setdefault((plan.plate_type, plan.base_file, plan.scale_factor), []).append(index)
+
+        plates = [None] * len(plans)
+        for indices in groups.values():
+            group_plans = [plans[index] for index in indices]
+            with run_profiler.stage('render'):
+                stack, group_bboxes = self.render_group(group_plans)
+            with run_profiler.stage('resize'):
+                if self.context.settings.image.render_at_scale:
+                    images = list(stack)
+                else:
+                    images = [utils.rescale_image(image, group_plans[0].scale_factor) for image in stack]
+            del stack
+            for index, plan, image, plate_bboxes in zip(indices, group_plans, images, group_bboxes):
+                plates[index] = self.compose(plan, image, plate_bboxes, bg_cache, warp_cache, run_profiler)
+
+        return plates
+
+
+    def plan(self, assignment, bg_cache, warp_cache=None):
+        """Draws every random choice of a plate, consuming the random generator as generate_plate does
+            A None assignment draws plate type and number at random
+        """
+        settings = self.context.settings
+        if assignment is None:
+            plate_type = utils.get_random_item(self.templates)
+            template = self.templates[plate_type]
+            base_file = utils.get_random_item(template["base-image"])
+            number_template = utils.get_random_item(template["plate-number"])
+            plate_number = self.registry.get_sampler(number_template["regex"]).sample()
+        else:
+            plate_type, number_template, plate_number = assignment
+            template = self.templates[plate_type]
+            base_file = utils.get_random_item(template["base-image"])
+            number_template = template["plate-number"][number_template]
+        texts = [(number_template, plate_number)]
+        for text_template in template.get("extra-text", []):
+            texts.append((text_template, self.registry.get_sampler(text_template["regex"]).sample()))
+        scale_factor = utils.get_random_item(settings.image.plate_scales)
+        angles = perspective.get_random_angles(settings.perspective.theta_range, settings.perspective.phi_range,
+            settings.perspective.gamma_range, settings.perspective.rotation_step)
+        background = bg_cache.get_random_key()
+
+        # Position is drawn last, from the size the plate will have once warped
+        width, height = utils.get_scaled_size(*self.registry.load_image(base_file).size, scale_factor)
+        warp_args = (width, height) + angles + (settings.perspective.scale, settings.perspective.field_of_view)
+        warp = warp_cache.get_warp(*warp_args) if warp_cache is not None else perspective.compute_warp(*warp_args)
+        width, height = perspective.get_warped_size(warp[1], warp[2], settings.perspective.crop_warp)
+        x1, y1, _, _ = scene.get_random_position(width, height, background[1][0], background[1][1])
+
+        return PlatePlan(plate_type, base_file, plate_number, texts, scale_factor, angles, background, (x1, y1))
+
+
+    def render_group(self, group_plans):
+        """Draws the texts of plates sharing template and base image, returns the stacked BGR images and their bounding boxes"""
+        base_file = group_plans[0].base_file
+        scale_factor = group_plans[0].scale_factor
+        render_scale = scale_factor if self.context.settings.image.render_at_scale else 1
+        base = self.registry.get_shared_array(base_file, render_scale)
+        width, height = self.registry.load_image(base_file).size
+        stack = np.empty((len(group_plans),) + base.shape, dtype=np.uint8)
+        stack[...] = base
+
+        bbox_classes, bbox_coords, bbox_counts = [], [], []
+        for image, plan in zip(stack, group_plans):
+            regions = []
+            for text_index, (text_template, text) in enumerate(plan.texts):
+                ink = self.registry.get_ink(text_template["color"])
+                draws, text_classes, text_coords = plate.layout_text(self.registry, text_template, text, render_scale)
+                for glyph, draw_position in draws:
+                    self.draw_glyph(image, (base_file, render_scale), glyph, draw_position, ink, regions)
+                if text_index == 0:
+                    # Plate number boxes followed by the whole plate box
+                    bbox_classes += text_classes + [plan.plate_type]
+                    bbox_coords += text_coords + [[0, 0, width, height]]
+                    bbox_counts.append(len(text_classes) + 1)
+
+        # Boxes of the whole group are created and scaled as a single array
+        group_bboxes = bboxes.BoundingBoxes.from_coords(bbox_classes, bbox_coords)
+        return stack, group_bboxes.scale(scale_factor).split(bbox_counts)
+
+
+    def draw_glyph(self, image, base_key, glyph, position, ink, regions):
+        """Draws a glyph from its shared tile, blends it in place if it overlaps glyphs already drawn"""
+        clip = glyph.get_region(position, image.shape[1], image.shape[0])
+        if clip is None:
+            return
+        region, mask = clip
+        x1, y1, x2, y2 = region
+        if any(x1 < ox2 and ox1 < x2 and y1 < oy2 and oy1 < y2 for ox1, oy1, ox2, oy2 in regions):
+            assets.blend_mask(image[y1:y2, x1:x2], mask, ink)
+        else:
+            image[y1:y2, x1:x2] = self.get_tile(base_key, glyph, region, mask, ink)
+        regions.append(region)
+
+
+    def get_tile(self, base_key, glyph, region, mask, ink):
+        """Returns the base image region with a glyph blended on it, least recently used tiles are evicted
+            base_key is the (base image, scale) pair the plate is drawn on
+        """
+        key = (base_key, glyph, region, tuple(ink))
+        tile = self.tiles.get(key)
+        if tile is not None:
+            self.tiles.move_to_end(key)
+            return tile
+
+        x1, y1, x2, y2 = region
+        tile = self.registry.get_shared_array(*base_key)[y1:y2, x1:x2].copy()
+        assets.blend_mask(tile, mask, ink)
+        if tile.nbytes <= self.max_bytes:
+            self.tiles[key] = tile
+            self.used_bytes += tile.nbytes
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.tiles.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+        return tile
+
+
+    def compose(self, plan, image, plate_bboxes, bg_cache, warp_cache=None, run_profiler=profiler.DISABLED):
+        """Applies perspective and background to a rendered plate"""
+        settings = self.context.settings
+        with run_profiler.stage('warp'):
+            image, alpha, plate_bboxes = perspective.warp_image(image, plan.angles[0], plan.angles[1], plan.angles[2],
+                settings.perspective.scale, settings.perspective.field_of_view, plate_bboxes,
+                settings.image.rotate_bboxes, warp_cache, settings.perspective.crop_warp)
+        with run_profiler.stage('background'):
+            background = bg_cache.get_bg(*plan.background).copy()
+        with run_profiler.stage('composite'):
+            image, plate_bboxes = scene.add_backgroud(image, alpha, plate_bboxes, self.context, background=background, position=plan.position)
+        return plate.Plate.from_image(self.context, plan.plate_type, plan.base_file, plan.plate_number, image, plate_bboxes, self.registry)
@@ -0,0 +1,122 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import numpy as np
+
+BBOX_FIELDS = ['cx', 'cy', 'w', 'h', 'angle']
+
+
+class BoundingBoxes(object):
+    """Collection of bounding boxes stored as a (N, 5) array of cx, cy, w, h, angle plus their classes"""
+
+    def __init__(self, boxes=None, classes=None):
+        if boxes is None:
+            boxes = np.zeros((0, len(BBOX_FIELDS)))
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, len(BBOX_FIELDS))
+        self.classes = np.array(classes if classes is not None else [], dtype=object)
+        assert(len(self.boxes) == len(self.classes))
+
+
+    @classmethod
+    def from_coords(cls, classes, coords):
+        """Creates boxes from a list of (x1,y1,x2,y2) rectangular coordinates"""
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+        boxes = np.zeros((len(coords), len(BBOX_FIELDS)))
+        boxes[:, 2] = coords[:, 2] - coords[:, 0] # w = x2 - x1
+        boxes[:, 3] = coords[:, 3] - coords[:, 1] # h = y2 - y1
+        boxes[:, 0] = coords[:, 0] + (boxes[:, 2] / 2)
+        boxes[:, 1] = coords[:, 1] + (boxes[:, 3] / 2)
+        return cls(boxes, classes)
+
+
+    def __len__(self):
+        return len(self.boxes)
+
+
+    def append(self, box_class, cx, cy, w, h, angle=0):
+        """Adds a single box at the end of the collection"""
+        self.boxes = np.vstack([self.boxes, [cx, cy, w, h, angle]])
+        self.classes = np.append(self.classes, np.array([box_class], dtype=object))
+
+
+    def extend(self, other):
+        """Adds all boxes from another collection at the end"""
+        self.boxes = np.vstack([self.boxes, other.boxes])
+        self.classes = np.concatenate([self.classes, other.classes])
+
+
+    def copy(self):
+        return BoundingBoxes(self.boxes.copy(), self.classes.copy())
+
+
+    def split(self, counts):
+        """Splits the collection in consecutive collections of the given sizes"""
+        sections = np.cumsum(counts)[:-1]
+        return [BoundingBoxes(boxes, classes) for boxes, classes in
+            zip(np.split(self.boxes, sections), np.split(self.classes, sections))]
+
+
+    def scale(self, scale_factor):
+        """Returns boxes scaled by a factor, all boxes at once"""
+        boxes = self.boxes.copy()
+        boxes[:, :4] *= scale_factor
+        return BoundingBoxes(boxes, self.classes)
+
+
+    def translate(self, dx, dy):
+        """Returns boxes moved by an (dx, dy) offset, all boxes at once"""
+        boxes = self.boxes.copy()
+        boxes[:, 0] += dx
+        boxes[:, 1] += dy
+        return BoundingBoxes(boxes, self.classes)
+
+
+    def get_coords(self):
+        """Returns (N, 4) integer x1,y1,x2,y2 coordinates, truncated as perspective.bbox_to_coords"""
+        cx, cy, w, h = self.boxes[:, 0], self.boxes[:, 1], self.boxes[:, 2], self.boxes[:, 3]
+        x1 = cx - w/2
+        y1 = cy - h/2
+        x2 = x1 + w
+        y2 = y1 + h
+        return np.trunc(np.stack([x1, y1, x2, y2], axis=1))
+
+
+    def get_corners(self):
+        """Returns (N, 4, 2) corners (x1,y1),(x2,y1),(x1,y2),(x2,y2) of the non-rotated boxes"""
+        coords = self.get_coords()
+        corners = np.stack([
+            coords[:, [0, 1]],
+            coords[:, [2, 1]],
+            coords[:, [0, 3]],
+            coords[:, [2, 3]]
+        ], axis=1)
+        return corners
+
+
+    def to_dict(self, index):
+        """Returns a single box in annotation format"""
+        bbox = {'class': self.classes[index]}
+        for field, value in zip(BBOX_FIELDS, self.boxes[index]):
+            bbox[field] = float(value)
+        return bbox
+
+
+    def to_dicts(self):
+        """Returns all boxes in annotation format, only meant to be used when annotating"""
+        return [self.to_dict(index) for index in range(len(self))]
@@ -0,0 +1,231 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import cv2
+import numpy as np
+
+import plate
+import context
+import jsonutil
+import generator
+import perspective
+import scene
+import utils
+import annotations
+
+BASELINE_FILE = 'benchmark_baseline.json'
+DEFAULT_ITERATIONS = 200
+DEFAULT_WARMUP = 50
+DEFAULT_TOLERANCE = 0.2
+SYNTHETIC_BACKGROUNDS = 16
+SYNTHETIC_BG_SIZE = (800, 600)
+
+
+def create_backgrounds(path, count=SYNTHETIC_BACKGROUNDS, size=SYNTHETIC_BG_SIZE, seed=0):
+    """Writes a fixed set of synthetic backgrounds, gradients with noise"""
+    rng = np.random.RandomState(seed)
+    gradient = np.linspace(0, 255, size[0], dtype=np.float32)[np.newaxis, :, np.newaxis]
+    for index in range(count):
+        noise = rng.normal(0, 40, (size[1], size[0], 3))
+        image = np.clip(gradient * rng.uniform(0.2, 1.0, 3) + noise, 0, 255).astype(np.uint8)
+        cv2.imwrite(os.path.join(path, "bg_{0:03d}.jpg".format(index)), image)
+
+
+def summarize(samples):
+    """Returns plates/sec and latency percentiles (ms) of a list of timings in seconds"""
+    samples = np.array(samples)
+    return {
+        'plates_per_sec': float(len(samples) / samples.sum()) if samples.sum() > 0 else 0.0,
+        'mean_ms': float(samples.mean() * 1000),
+        'p50_ms': float(np.percentile(samples, 50) * 1000),
+        'p99_ms': float(np.percentile(samples, 99) * 1000)
+    }
+
+
+def timed(samples, func, *args):
+    """Calls a function, appends its duration to samples and returns its result"""
+    start = time.perf_counter()
+    result = func(*args)
+    samples.append(time.perf_counter() - start)
+    return result
+
+
+def warm_up(appContext, templates, caches, iterations, seed):
+    """Fills caches before timing, so results show steady state costs"""
+    registry, warp_cache, bg_cache = caches
+    for bg_file in bg_cache.bg_list:
+        for size in bg_cache.sizes:
+            bg_cache.get_bg(bg_file, size)
+    for index in range(iterations):
+        generator.seed_random(seed, -1 - index)
+        generator.generate_plate(appContext, templates, registry, bg_cache, warp_cache)
+
+
+def run_stages(appContext, templates, caches, iterations, seed, output_path):
+    """Times each pipeline stage in isolation, inputs of a stage are produced by the previous ones"""
+    registry, warp_cache, bg_cache = caches
+    rotate_bboxes = appContext.settings.image.rotate_bboxes
+    settings = appContext.settings.perspective
+    annotators = dict((name, annotations.AnnotatorFactory.get_annotator(name)) for name in annotations.AnnotatorFactory.get_prefixes())
+    for name, annotator in annotators.items():
+        annotator.open_annotations(output_path)
+
+    stages = ['render', 'draw_regex', 'random_resize', 'warp_image', 'warp_bboxes', 'add_backgroud', 'save_image']
+    stages += ["annotator_{0}".format(name) for name in annotators]
+    stages += ["annotator_{0}_save".format(name) for name in annotators]
+    samples = dict((stage, []) for stage in stages)
+    for index in range(iterations):
+        generator.seed_random(seed, index)
+        plate_type = utils.get_random_item(templates)
+        template = templates[plate_type]
+        new_plate = timed(samples['render'], plate.Plate, appContext, plate_type, template, registry)
+
+        # Text drawing alone, over a fresh copy of the base image
+        text_plate = copy.copy(new_plate)
+        text_plate.image_data = registry.get_image_array(new_plate.base_file, new_plate.scale_factor)
+        timed(samples['draw_regex'], text_plate.draw_regex, template["plate-number"][0])
+
+        timed(samples['random_resize'], new_plate.random_resize)
+
+        theta, phi, gamma = perspective.get_random_angles(settings.theta_range, settings.phi_range, settings.gamma_range, settings.rotation_step)
+        height, width = new_plate.image_data.shape[:2]
+        warped_image, warped_alpha, _ = timed(samples['warp_image'], perspective.warp_image,
+            new_plate.image_data, theta, phi, gamma, settings.scale, settings.field_of_view, None, rotate_bboxes, warp_cache, settings.crop_warp)
+        matrix, _, crop_points, _ = warp_cache.get_warp(width, height, theta, phi, gamma, settings.scale, settings.field_of_view)
+        warped_bboxes = timed(samples['warp_bboxes'], perspective.warp_bboxes,
+            new_plate.bounding_boxes, matrix, crop_points, rotate_bboxes)
+        new_plate.image_data, new_plate.alpha, new_plate.bounding_boxes = warped_image, warped_alpha, warped_bboxes
+
+        new_plate.image_data, new_plate.bounding_boxes = timed(samples['add_backgroud'], scene.add_backgroud,
+            new_plate.image_data, new_plate.alpha, new_plate.bounding_boxes, appContext, bg_cache)
+        new_plate.alpha = None
+
+        timed(samples['save_image'], new_plate.save_image, output_path)
+        for name, annotator in annotators.items():
+            timed(samples["annotator_{0}".format(name)], annotator.append_annotation, new_plate)
+
+    # Saving is timed once per annotator, i.e: npz builds its columns from the streamed annotations
+    for name, annotator in annotators.items():
+        timed(samples["annotator_{0}_save".format(name)], annotator.save_annotations, output_path)
+
+    return dict((stage, summarize(stage_samples)) for stage, stage_samples in samples.items())
+
+
+def run_end_to_end(appContext, templates, caches, iterations, seed, output_path):
+    """Times the whole single process loop: generate, save and annotate"""
+    registry, warp_cache, bg_cache = caches
+    annotator = annotations.AnnotatorFactory.get_annotator('tf')
+    annotator.open_annotations(output_path)
+
+    samples = []
+    for index in range(iterations):
+        generator.seed_random(seed, index)
+        start = time.perf_counter()
+        new_plate = generator.generate_plate(appContext, templates, registry, bg_cache, warp_cache)
+        new_plate.save_image(output_path)
+        annotator.append_annotation(new_plate)
+        samples.append(time.perf_counter() - start)
+    annotator.save_annotations(output_path)
+
+    return summarize(samples)
+
+
+def run_benchmarks(config_path, templates_path, iterations, seed, warmup=DEFAULT_WARMUP):
+    """Runs all benchmarks over a temporary synthetic background set and output directory"""
+    appContext = context.Context(config_path)
+    templates = jsonutil.deserializeJson(templates_path)
+    work_path = tempfile.mkdtemp(prefix='plates-benchmark-')
+    try:
+        bg_path = os.path.join(work_path, 'backgrounds')
+        output_path = os.path.join(work_path, 'output')
+        os.makedirs(bg_path)
+        os.makedirs(output_path)
+        create_backgrounds(bg_path)
+        appContext.setConfig('General', 'backgrounds_path', bg_path)
+
+        registry, warp_cache = generator.load_assets(appContext, templates)
+        caches = (registry, warp_cache, scene.BackgroundCache(appContext))
+        warm_up(appContext, templates, caches, warmup, seed)
+
+        results = run_stages(appContext, templates, caches, iterations, seed, output_path)
+        results['end_to_end'] = run_end_to_end(appContext, templates, caches, iterations, seed, output_path)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns (stage, current p50, baseline p50) of stages slower than baseline by more than tolerance"""
+    regressions = []
+    for stage, summary in results.items():
+        if stage not in baseline:
+            continue
+        limit = baseline[stage]['p50_ms'] * (1.0 + tolerance)
+        if summary['p50_ms'] > limit:
+            regressions.append((stage, summary['p50_ms'], baseline[stage]['p50_ms']))
+    return regressions
+
+
+def print_results(results, baseline):
+    print("{0:<20}{1:>12}{2:>10}{3:>10}{4:>14}".format('stage', 'plates/sec', 'p50 ms', 'p99 ms', 'baseline p50'))
+    for stage, summary in results.items():
+        baseline_p50 = "{0:.3f}".format(baseline[stage]['p50_ms']) if stage in baseline else '-'
+        print("{0:<20}{1:>12.1f}{2:>10.3f}{3:>10.3f}{4:>14}".format(stage,
+            summary['plates_per_sec'], summary['p50_ms'], summary['p99_ms'], baseline_p50))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-stage benchmarks of the plate generation pipeline')
+    parser.add_argument('--config', default='configuration.cfg')
+    parser.add_argument('--templates', default='templates.json')
+    parser.add_argument('--iterations', type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP, help='Untimed plates generated first to fill caches')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='Baseline results to compare against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed p50 slowdown, 0.2 = 20%%')
+    parser.add_argument('--save-baseline', action='store_true', help='Store results as the new baseline')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.config, args.templates, args.iterations, args.seed, args.warmup)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print("Baseline saved to {0}".format(args.baseline))
+    else:
+        regressions = compare(results, baseline, args.tolerance)
+        for stage, current, previous in regressions:
+            print("REGRESSION {0}: p50 {1:.3f} ms, baseline {2:.3f} ms".format(stage, current, previous))
+        if regressions:
+            sys.exit(1)
@@ -17,18 +17,210 @@
 #######################################################################
 #!/usr/bin/python
 
+import ast
 import configparser
+from collections import namedtuple
+
+import annotations
+
+
+class ConfigurationError(ValueError):
+    """Raised when a configuration value is missing or not valid"""
+    pass
+
+
+#region Value parsers
+def parse_int(minimum=None):
+    def parse(value):
+        result = int(value)
+        if minimum is not None and result < minimum:
+            raise ValueError("expected an integer >= {0}".format(minimum))
+        return result
+    return parse
+
+
+def parse_float(minimum=None, exclusive=False):
+    def parse(value):
+        result = float(value)
+        if minimum is not None and (result < minimum or (exclusive and result == minimum)):
+            raise ValueError("expected a number {0} {1}".format('>' if exclusive else '>=', minimum))
+        return result
+    return parse
+
+
+def parse_bool(value):
+    states = configparser.ConfigParser.BOOLEAN_STATES
+    if value.lower() not in states:
+        raise ValueError("expected a boolean")
+    return states[value.lower()]
+
+
+def parse_string(value):
+    if not value:
+        raise ValueError("expected a non empty value")
+    return value
+
+
+def parse_choice(*choices):
+    def parse(value):
+        if value not in choices:
+            raise ValueError("expected one of {0}".format(", ".join(choices)))
+        return value
+    return parse
+
+
+def parse_optional_int(value):
+    return int(value) if value else None
+
+
+def parse_literal(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        raise ValueError("expected a Python literal")
+
+
+def parse_scales(value):
+    scales = parse_literal(value)
+    if not isinstance(scales, (list, tuple)) or not scales or not all(isinstance(x, (int, float)) and x > 0 for x in scales):
+        raise ValueError("expected a non empty list of positive numbers")
+    return tuple(scales)
+
+
+def parse_pair(value):
+    pair = parse_literal(value)
+    if not isinstance(pair, (list, tuple)) or len(pair) != 2 or not all(isinstance(x, (int, float)) for x in pair):
+        raise ValueError("expected a [x, y] pair of numbers")
+    return tuple(pair)
+
+
+def parse_sizes(value):
+    sizes = parse_literal(value)
+    if not isinstance(sizes, (list, tuple)) or not sizes:
+        raise ValueError("expected a non empty list of [width, height] sizes")
+    for size in sizes:
+        if not isinstance(size, (list, tuple)) or len(size) != 2 or not all(isinstance(x, int) and x > 0 for x in size):
+            raise ValueError("expected a non empty list of [width, height] sizes")
+    return tuple(tuple(size) for size in sizes)
+
+
+def parse_angle_range(value):
+    angle_range = parse_literal(value)
+    if (not isinstance(angle_range, (list, tuple)) or len(angle_range) != 2
+            or not all(isinstance(x, int) for x in angle_range) or angle_range[0] >= angle_range[1]):
+        raise ValueError("expected a [min, max] range of integer angles, min < max")
+    return tuple(angle_range)
+
+
+def parse_field_of_view(value):
+    fov = int(value)
+    if not 0 < fov < 180:
+        raise ValueError("expected an angle between 0 and 180")
+    return fov
+#endregion
+
+
+# Settings schema: section -> [(key, parser, default)], keys without default are required
+SETTINGS_SCHEMA = {
+    'General': [
+        ('dataset_size', parse_int(0), None),
+        ('templates_path', parse_string, None),
+        ('templates_config', str, ''),
+        ('backgrounds_path', parse_string, None),
+        ('output_path', parse_string, None),
+        ('clear_output', parse_bool, None),
+        ('annotation_type', parse_choice(*annotations.AnnotatorFactory.get_prefixes()), None),
+        ('output_format', parse_choice('files', 'shards'), 'files'),
+        ('shard_size', parse_int(1), '10000'),
+        ('writer_threads', parse_int(0), '2'),
+        ('writer_queue_size', parse_int(1), '64'),
+        ('fsync', parse_bool, 'False'),
+        ('workers', parse_int(0), '0'),
+        ('seed', parse_optional_int, ''),
+        ('shard_index', parse_int(0), '0'),
+        ('shard_count', parse_int(1), '1'),
+        ('profile', parse_bool, 'False'),
+        ('batch_render', parse_bool, 'False')
+    ],
+    'Image': [
+        ('resize_plate', parse_bool, 'True'),
+        ('plate_scales', parse_scales, None),
+        ('resize_bg', parse_bool, 'True'),
+        ('bg_sizes', parse_sizes, None),
+        ('bg_cache_size', parse_float(0), '512'),
+        ('tile_cache_size', parse_float(0), '256'),
+        ('render_at_scale', parse_bool, 'False'),
+        ('pyramid_cache_path', str, ''),
+        ('plates_per_scene', parse_int(1), '1'),
+        ('draw_bboxes', parse_bool, 'False'),
+        ('bbox_padding', parse_pair, None),
+        ('rotate_bboxes', parse_bool, 'False')
+    ],
+    'Perspective': [
+        ('theta_range', parse_angle_range, None),
+        ('phi_range', parse_angle_range, None),
+        ('gamma_range', parse_angle_range, None),
+        ('rotation_step', parse_int(1), None),
+        ('field_of_view', parse_field_of_view, None),
+        ('scale', parse_float(0, exclusive=True), None),
+        ('crop_warp', parse_bool, 'False'),
+        ('warp_cache_size', parse_int(0), '100000'),
+        ('precompute_warps', parse_bool, 'False')
+    ]
+}
+
+GeneralSettings = namedtuple('GeneralSettings', [key for key, _, _ in SETTINGS_SCHEMA['General']])
+ImageSettings = namedtuple('ImageSettings', [key for key, _, _ in SETTINGS_SCHEMA['Image']])
+PerspectiveSettings = namedtuple('PerspectiveSettings', [key for key, _, _ in SETTINGS_SCHEMA['Perspective']])
+Settings = namedtuple('Settings', ['general', 'image', 'perspective'])
+
+
+def compile_settings(configuration):
+    """Parses and validates a configuration once, returns immutable typed settings"""
+    sections = {}
+    for section, keys in SETTINGS_SCHEMA.items():
+        values = []
+        for key, parser, default in keys:
+            value = configuration.get(section, key, fallback=default)
+            if value is None:
+                raise ConfigurationError("[{0}] {1}: missing required setting".format(section, key))
+            try:
+                values.append(parser(value.strip()))
+            except ValueError as error:
+                raise ConfigurationError("[{0}] {1} = {2!r}: {3}".format(section, key, value, error))
+        sections[section] = values
+
+    settings = Settings(
+        general=GeneralSettings(*sections['General']),
+        image=ImageSettings(*sections['Image']),
+        perspective=PerspectiveSettings(*sections['Perspective']))
+
+    # Settings that depend on each other
+    if settings.general.shard_index >= settings.general.shard_count:
+        raise ConfigurationError("[General] shard_index = {0}: expected an index lower than shard_count = {1}".format(
+            settings.general.shard_index, settings.general.shard_count))
+    if settings.general.shard_count > 1 and settings.general.seed is None:
+        raise ConfigurationError("[General] seed: required when shard_count > 1, every node has to draw the same dataset")
+    if settings.general.batch_render and settings.image.plates_per_scene > 1:
+        raise ConfigurationError("[General] batch_render: only supported with one plate per image, plates_per_scene = {0}".format(
+            settings.image.plates_per_scene))
+    return settings
+
 
 class Context(object):
-    """Contains configuration general to all the application"""
+    """Contains configuration general to all the application
+        settings holds the compiled, typed configuration to be used on hot paths
+    """
 
     def __init__(self, configurationPath):
         self.configuration = None
         self.configurationPath = None
+        self.settings = None
         self.loadConfig(configurationPath)
 
     def setConfig(self, section, key, value):
         self.configuration.set(section, key, value)
+        self.settings = compile_settings(self.configuration)
 
     def getConfig(self, section, key):
         return self.configuration.get(section, key)
@@ -44,5 +236,5 @@ class Context(object):
         self.configuration = configparser.ConfigParser()
         self.configurationPath = configurationPath
         with open(configurationPath) as configFile:
-            self.configuration.readfp(configFile)
-        
+            self.configuration.read_file(configFile)
+        self.settings = compile_settings(self.configuration)
@@ -0,0 +1,348 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import os
+import random
+import itertools
+import multiprocessing
+from collections import deque
+
+import plate
+import perspective
+import scene
+import utils
+import assets
+import batch
+import shards
+import writer
+import profiler
+import annotations
+
+CHUNK_SIZE = 32
+
+#region Module Functions
+__worker_state = None
+
+
+def get_workers(context):
+    """Returns configured number of worker processes, 0 means one per CPU core"""
+    workers = context.settings.general.workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+
+def get_seed(context):
+    """Returns configured base seed, or a random one if not set"""
+    seed = context.settings.general.seed
+    if seed is None:
+        return random.SystemRandom().randrange(2**32)
+    return seed
+
+
+def seed_random(seed, index):
+    """Seeds the random generator with an independent stream for a given chunk"""
+    random.seed("{0}-{1}".format(seed, index))
+
+
+def generate_plate(context, templates, registry=None, bg_cache=None, warp_cache=None, run_profiler=profiler.DISABLED, assignment=None):
+    """Generates a random plate with size, perspective and background applied
+        assignment is a (plate_type, number_template, plate_number) from a PlateNumberIndex, random type and number if None
+    """
+    new_plate = prepare_plate(context, templates, registry, warp_cache, run_profiler, assignment)
+    with run_profiler.stage('background'):
+        background = scene.get_random_bg(context, bg_cache)
+    with run_profiler.stage('composite'):
+        new_plate.image_data, new_plate.bounding_boxes = scene.add_backgroud(new_plate.image_data, new_plate.alpha, new_plate.bounding_boxes, context, background=background)
+        new_plate.alpha = None
+
+    return new_plate
+
+
+def prepare_plate(context, templates, registry=None, warp_cache=None, run_profiler=profiler.DISABLED, assignment=None):
+    """Generates a random plate with size and perspective applied, ready to be placed on a background"""
+    # Generate from assigned or random template
+    with run_profiler.stage('render'):
+        if assignment is None:
+            plate_type = utils.get_random_item(templates)
+            new_plate = plate.Plate(context, plate_type, templates[plate_type], registry)
+        else:
+            plate_type, number_template, plate_number = assignment
+            new_plate = plate.Plate(context, plate_type, templates[plate_type], registry, number_template, plate_number)
+
+    # Change size and perspective
+    with run_profiler.stage('resize'):
+        new_plate.random_resize()
+    with run_profiler.stage('warp'):
+        new_plate.image_data, new_plate.alpha, new_plate.bounding_boxes = perspective.warp_image_random(new_plate.image_data, new_plate.bounding_boxes, context, warp_cache)
+
+    return new_plate
+
+
+def generate_scenes(context, templates, assignments, registry=None, bg_cache=None, warp_cache=None, run_profiler=profiler.DISABLED):
+    """Generates scenes of up to plates_per_scene plates over one background each, from assignments in order
+        Plates that do not fit on a scene are moved to the next one
+    """
+    plates_per_scene = context.settings.image.plates_per_scene
+    pending = deque(prepare_plate(context, templates, registry, warp_cache, run_profiler, assignment) for assignment in assignments)
+    while pending:
+        with run_profiler.stage('background'):
+            background = scene.get_random_bg(context, bg_cache)
+        with run_profiler.stage('composite'):
+            scene_plates = [pending.popleft() for _ in range(min(plates_per_scene, len(pending)))]
+            new_scene, remaining = scene.compose_scene(scene_plates, background, context)
+            pending.extendleft(reversed(remaining))
+        yield new_scene
+
+
+def get_chunks(dataset_size, chunk_size=CHUNK_SIZE):
+    """Splits the dataset in (chunk_index, size) tasks"""
+    chunks = []
+    for index, start in enumerate(range(0, dataset_size, chunk_size)):
+        chunks.append((index, min(chunk_size, dataset_size - start)))
+    return chunks
+
+
+def get_node_chunks(context, dataset_size):
+    """Returns the chunks of the dataset up to the end of this node slice and the position of its first chunk
+        Slices are contiguous ranges of chunks, all slices together make the same dataset as a single node run
+    """
+    settings = context.settings.general
+    chunks = get_chunks(dataset_size)
+    start = len(chunks) * settings.shard_index // settings.shard_count
+    end = len(chunks) * (settings.shard_index + 1) // settings.shard_count
+    return chunks[:end], start
+
+
+def get_node_size(context, dataset_size):
+    """Returns the number of plates generated by this node"""
+    chunks, start = get_node_chunks(context, dataset_size)
+    return sum(chunk_size for _, chunk_size in chunks[start:])
+
+
+def assign_chunks(chunks, number_index, start=0):
+    """Yields (chunk_index, assignments) tasks, plate numbers are drawn in order so they are unique and reproducible
+        Chunks before start are assigned but not yielded, they belong to other nodes
+    """
+    for position, (chunk_index, chunk_size) in enumerate(chunks):
+        assignments = number_index.assign(chunk_size)
+        if position >= start:
+            yield chunk_index, assignments
+
+
+def load_assets(context, templates):
+    """Loads template assets and warp matrices, shared by all workers"""
+    registry = assets.AssetRegistry(context)
+    registry.preload(templates)
+    if context.settings.image.render_at_scale:
+        registry.preload_levels(context.settings.image.plate_scales)
+    warp_cache = perspective.get_warp_cache(context, registry.get_scaled_sizes(context.settings.image.plate_scales))
+    return registry, warp_cache
+
+
+def get_shard_writer(context, output_path):
+    """Returns a shard writer if output format is set to shards, None when plates are saved as files"""
+    settings = context.settings.general
+    if settings.output_format == 'shards':
+        return shards.ShardWriter(output_path, settings.shard_size, settings.shard_index if settings.shard_count > 1 else None, settings.fsync)
+    return None
+
+
+def get_image_writer(context, run_profiler=None):
+    """Creates a background image writer from settings"""
+    settings = context.settings.general
+    return writer.ImageWriter(settings.writer_threads, settings.writer_queue_size, run_profiler, settings.fsync)
+
+
+def get_profiler(context):
+    """Creates a profiler, enabled only if configured"""
+    return profiler.Profiler(context.settings.general.profile)
+
+
+def initialize_worker(context, templates, registry, warp_cache, seed, output_mode, annotator_type=None, output_path=None, workers=1):
+    """Prepares the state shared by all chunks generated on a worker process
+        output_mode: 'files' saves plates to disk, 'shards' returns encoded records, 'memory' returns image arrays
+        Memory budgets of the caches are split between the worker processes
+    """
+    global __worker_state
+    annotator = annotations.AnnotatorFactory.get_annotator(annotator_type) if annotator_type else None
+    run_profiler = get_profiler(context)
+    __worker_state = {
+        'context': context,
+        'templates': templates,
+        'registry': registry,
+        'bg_cache': scene.BackgroundCache(context, workers),
+        'warp_cache': warp_cache,
+        'image_writer': get_image_writer(context, run_profiler) if output_mode == 'files' else None,
+        'profiler': run_profiler,
+        'renderer': batch.BatchRenderer(context, templates, registry, workers) if context.settings.general.batch_render else None,
+        'annotator': annotator,
+        'output_path': output_path,
+        'seed': seed,
+        'output_mode': output_mode
+    }
+
+
+def generate_chunk(chunk):
+    """Generates a chunk of plates, returns its index, plate file names, annotations, records, failed writes and profiling state
+        Records are (filename, encoded image, annotation) to be packed on shards, or (image, annotation) in memory
+    """
+    chunk_index, assignments = chunk
+    state = __worker_state
+    seed_random(state['seed'], chunk_index)
+
+    chunk_filenames = []
+    chunk_annotations = []
+    chunk_records = []
+    run_profiler = state['profiler']
+    if state['renderer'] is not None:
+        plates = state['renderer'].generate(assignments, state['bg_cache'], state['warp_cache'], run_profiler)
+    elif state['context'].settings.image.plates_per_scene > 1:
+        plates = generate_scenes(state['context'], state['templates'], assignments, state['registry'], state['bg_cache'], state['warp_cache'], run_profiler)
+    else:
+        plates = (generate_plate(state['context'], state['templates'], state['registry'], state['bg_cache'], state['warp_cache'], run_profiler, assignment)
+            for assignment in assignments)
+    for new_plate in plates:
+        chunk_filenames.append(new_plate.get_filename())
+        if state['output_mode'] == 'files':
+            save_path = os.path.join(state['output_path'], new_plate.get_filename())
+            state['image_writer'].submit(save_path, new_plate.get_output_image())
+        elif state['output_mode'] == 'shards':
+            with run_profiler.stage('encode'):
+                chunk_records.append((new_plate.get_filename(), new_plate.encode_image(), new_plate.get_annotation()))
+        else:
+            chunk_records.append((new_plate.get_output_image(), new_plate.get_annotation()))
+        if state['annotator'] is not None:
+            with run_profiler.stage('annotate'):
+                chunk_annotations.extend(state['annotator'].get_annotations(new_plate))
+        run_profiler.count('plates', len(new_plate.get_plates()))
+
+    # Chunk is complete once all of its images are on disk
+    chunk_failures = state['image_writer'].flush() if state['image_writer'] is not None else []
+
+    return chunk_index, chunk_filenames, chunk_annotations, chunk_records, chunk_failures, run_profiler.pop_state()
+
+
+def get_manifest_header(context, seed):
+    """Returns the settings that define the plates of a run, a run can only be resumed with the same ones"""
+    settings = context.settings.general
+    return {'seed': seed, 'chunk_size': CHUNK_SIZE, 'annotation_type': settings.annotation_type,
+        'output_format': settings.output_format, 'shard_index': settings.shard_index, 'shard_count': settings.shard_count,
+        'plates_per_scene': context.settings.image.plates_per_scene}
+
+
+def generate_dataset(context, templates, annotator, annotator_type, dataset_size, output_path, run_profiler=profiler.DISABLED, run_manifest=None, seed=None):
+    """Generates the dataset using a pool of worker processes, annotations are merged in order
+        With a run manifest, chunks it records as complete are skipped and every new chunk is recorded
+        Returns the list of (path, error) images that could not be written
+    """
+    workers = get_workers(context)
+    seed = seed if seed is not None else get_seed(context)
+    registry, warp_cache = load_assets(context, templates)
+    chunks, start = get_node_chunks(context, dataset_size)
+    shard_writer = get_shard_writer(context, output_path)
+
+    # Resume after the last complete chunk, annotations and shards written after it are discarded
+    completed, last_record = 0, None
+    if run_manifest is not None:
+        completed, last_record = run_manifest.get_completed(chunks[start:])
+        run_manifest.open(get_manifest_header(context, seed), completed)
+    if last_record is None:
+        annotator.open_annotations(output_path)
+    else:
+        annotator.open_annotations(output_path, last_record['annotations_offset'])
+        if shard_writer is not None and last_record['shard_position'] is not None:
+            shard_writer.resume(last_record['shard_position'])
+    chunk_sizes = dict(chunks)
+    chunks = assign_chunks(chunks, plate.PlateNumberIndex(templates, registry, seed), start + completed)
+    output_mode = 'files' if shard_writer is None else 'shards'
+    init_args = (context, templates, registry, warp_cache, seed, output_mode, annotator_type, output_path, workers)
+
+    pool = None
+    if workers == 1:
+        # Run in-process, same seeding as the pool so results are identical
+        initialize_worker(*init_args)
+        results = map(generate_chunk, chunks)
+    else:
+        pool = multiprocessing.Pool(workers, initializer=initialize_worker, initargs=init_args)
+        results = pool.imap(generate_chunk, chunks)
+
+    failures = []
+    try:
+        for chunk_index, chunk_filenames, chunk_annotations, chunk_records, chunk_failures, chunk_profile in results:
+            with run_profiler.stage('annotations_write'):
+                annotator.add_annotations(chunk_annotations)
+            for record in chunk_records:
+                with run_profiler.stage('shard_write'):
+                    shard_writer.write(*record)
+                run_profiler.count('bytes_written', len(record[1]))
+            failures.extend(chunk_failures)
+            run_profiler.merge(chunk_profile)
+            # Chunks are recorded in order, a run resumes after the last chunk without failures
+            if run_manifest is not None and not failures:
+                with run_profiler.stage('manifest_write'):
+                    shard_position = shard_writer.get_position() if shard_writer is not None else None
+                    run_manifest.add_chunk(chunk_index, chunk_sizes[chunk_index], chunk_filenames, annotator.get_offset(), shard_position)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if shard_writer is not None:
+            shard_writer.close()
+        if run_manifest is not None:
+            run_manifest.close()
+    run_profiler.count('failed_writes', len(failures))
+
+    return failures
+
+
+def generate_plates(context, templates, count=None, workers=None, prefetch=None, seed=None):
+    """Yields (image, annotation) pairs straight from memory, plates are generated by background workers
+        Images are BGR arrays as they would be saved, annotations are the plate annotation dicts.
+        At most `prefetch` chunks are generated ahead of the consumer, count=None generates plates forever.
+    """
+    workers = workers if workers is not None else get_workers(context)
+    prefetch = prefetch if prefetch is not None else 2 * workers
+    seed = seed if seed is not None else get_seed(context)
+    registry, warp_cache = load_assets(context, templates)
+    if count is None:
+        chunks = ((index, CHUNK_SIZE) for index in itertools.count())
+    else:
+        chunks = get_chunks(count)
+    # No files are written, plate types and numbers are drawn at random without keeping them unique
+    chunks = ((chunk_index, [None] * chunk_size) for chunk_index, chunk_size in chunks)
+
+    pool = multiprocessing.Pool(workers, initializer=initialize_worker,
+        initargs=(context, templates, registry, warp_cache, seed, 'memory', None, None, workers))
+    pending = deque()
+    try:
+        while True:
+            # Keep the queue of chunks being generated full, then hand over the oldest one
+            for chunk in itertools.islice(chunks, max(0, prefetch - len(pending))):
+                pending.append(pool.apply_async(generate_chunk, (chunk,)))
+            if not pending:
+                break
+            _, _, _, chunk_records, _, _ = pending.popleft().get()
+            for record in chunk_records:
+                yield record
+    finally:
+        pool.terminate()
+        pool.join()
+
+#endregion
@@ -18,31 +18,50 @@
 #!/usr/bin/python
 
 import os
+import sys
 import glob
 import time
+import argparse
 
-import plate
 import context
 import jsonutil
-import perspective
-import scene
 import utils
+import generator
+import profiler
+import manifest
 import annotations
 
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generates a dataset of random plates')
+    parser.add_argument('--grow', type=int, help='Adds this many plates to the dataset on output_path, instead of dataset_size')
+    parser.add_argument('--overwrite', action='store_true', help='Clears a resumable run on output_path when clear_output = True')
+    args = parser.parse_args()
+
     # Initialize settings
     appContext = context.Context('configuration.cfg')
     templates = jsonutil.deserializeJson('templates.json')
 
-    dataset_size = int(appContext.getConfig('General', 'dataset_size'))
-    output_path = appContext.getConfig('General', 'output_path')
-    annotator_type = appContext.getConfig('General', 'annotation_type')
+    dataset_size = appContext.settings.general.dataset_size
+    output_path = appContext.settings.general.output_path
+    annotator_type = appContext.settings.general.annotation_type
     annotator = annotations.AnnotatorFactory.get_annotator(annotator_type)
+    # Nodes of a sharded run generate a slice of the dataset, with their own annotation file
+    shard_index = appContext.settings.general.shard_index
+    shard_count = appContext.settings.general.shard_count
+    annotator.shard_index, annotator.shard_count = shard_index, shard_count
+    annotator.fsync = appContext.settings.general.fsync
     
+    # A run with a manifest can be resumed or grown, it is only cleared when asked explicitly
+    clear_output = appContext.settings.general.clear_output
+    manifest_path = os.path.join(output_path, utils.get_node_filename(manifest.MANIFEST_NAME, 'jsonl', shard_index, shard_count))
+    if args.grow is not None and clear_output:
+        parser.error("--grow adds plates to the dataset on {0}, set clear_output = False to keep it".format(output_path))
+    if clear_output and os.path.exists(manifest_path) and not args.overwrite:
+        parser.error("{0} holds a run that can be resumed or grown, set clear_output = False to keep it or pass --overwrite to clear it".format(output_path))
+
     # Create output directory or clean it
-    clear_output = appContext.getBoolean('General', 'clear_output')
     if not os.path.exists(output_path): 
         os.makedirs(output_path)
     elif clear_output:
@@ -50,21 +69,38 @@ if __name__ == "__main__":
         for f in files:
             os.remove(f)
 
-    for i in range(dataset_size):
-        # Generate from random template
-        plate_type = utils.get_random_item(templates)
-        new_plate = plate.Plate(appContext, plate_type, templates[plate_type])
-        
-        # Change perspective, size and background
-        new_plate.random_resize()
-        new_plate.image_data, new_plate.bounding_boxes = perspective.warp_image_random(new_plate.image_data, new_plate.bounding_boxes, appContext)
-        new_plate.image_data, new_plate.bounding_boxes = scene.add_backgroud(new_plate.image_data, new_plate.bounding_boxes, appContext)
-
-        # Generate annotation and image file
-        annotator.append_annotation(new_plate)
-        new_plate.save_image(output_path)
-        time.sleep(0.5) # TODO: Find solution for random images that are not written to disk
+    # Completed chunks are recorded, a run on the same output resumes or grows the dataset
+    run_manifest = manifest.RunManifest(manifest_path, appContext.settings.general.fsync)
+    if args.grow is not None:
+        if shard_count > 1:
+            parser.error("--grow is only supported on single node runs, slices of a sharded run change with dataset_size")
+        dataset_size = run_manifest.get_plate_count() + args.grow
+    seed = appContext.settings.general.seed
+    if seed is None:
+        seed = run_manifest.get_seed()
+    node_size = generator.get_node_size(appContext, dataset_size)
+
+    # Annotations are streamed to disk while plates are generated
+    run_profiler = generator.get_profiler(appContext)
+    start_time = time.time()
+    failures = generator.generate_dataset(appContext, templates, annotator, annotator_type, dataset_size, output_path, run_profiler, run_manifest, seed)
 
     # Save annotations
-    annotator.save_annotations(output_path)
+    with run_profiler.stage('annotations_write'):
+        annotator.save_annotations(output_path)
+
+    # Save run report next to the annotations
+    if run_profiler.enabled:
+        elapsed = time.time() - start_time
+        report_file = utils.get_node_filename(profiler.REPORT_NAME, 'json', shard_index, shard_count)
+        generated = run_profiler.counters.get('plates', 0)
+        run_profiler.save_report(os.path.join(output_path, report_file), dataset_size=node_size, generated_plates=generated,
+            shard_index=shard_index, shard_count=shard_count, workers=generator.get_workers(appContext), elapsed_s=elapsed,
+            plates_per_sec=generated / elapsed)
+
+    # Report images that could not be written
+    if failures:
+        for path, error in failures:
+            sys.stderr.write("Failed to write {0}: {1}\n".format(path, error))
+        sys.exit(1)
 
@@ -0,0 +1,113 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+
+import os
+import json
+
+import utils
+
+MANIFEST_NAME = "manifest"
+
+
+class RunManifest(object):
+    """Records the chunks a run has completed, so an interrupted run can resume and a finished one can grow
+        JSON Lines file: a header with the settings that define the dataset, then one line per completed chunk
+        with its plate file names and where the annotation file (and shard) ended after it
+    """
+
+    def __init__(self, path, fsync=False):
+        self.path = path
+        self.fsync = fsync
+        self.header = None
+        self.chunks = []
+        self.file = None
+        if os.path.exists(path):
+            self.load()
+
+
+    def load(self):
+        with open(self.path) as f:
+            lines = f.read().splitlines()
+        if not lines:
+            return
+        self.header = json.loads(lines[0])
+        for line in lines[1:]:
+            try:
+                self.chunks.append(json.loads(line))
+            except ValueError:
+                # Line cut by an interruption, its chunk is generated again
+                break
+
+
+    def get_seed(self):
+        return self.header['seed'] if self.header is not None else None
+
+
+    def get_plate_count(self):
+        """Returns the number of plates of completed chunks"""
+        return sum(chunk['size'] for chunk in self.chunks)
+
+
+    def check(self, header):
+        """Raises ValueError if the recorded run was generated with different settings"""
+        if self.header is None:
+            return
+        for key, value in header.items():
+            if self.header.get(key) != value:
+                raise ValueError("Output was generated with {0} = {1}, current run uses {2}, clear the output to start over".format(
+                    key, self.header.get(key), value))
+
+
+    def get_completed(self, chunks):
+        """Returns how many of the (chunk_index, size) chunks are already complete, and the record of the last one"""
+        completed = 0
+        for (chunk_index, chunk_size), record in zip(chunks, self.chunks):
+            if record['chunk'] != chunk_index or record['size'] != chunk_size:
+                break
+            completed += 1
+        return completed, self.chunks[completed - 1] if completed else None
+
+
+    def open(self, header, completed=0):
+        """Starts recording, keeps the header and the first completed chunks, chunks after them are discarded"""
+        self.check(header)
+        self.header = header
+        self.chunks = self.chunks[:completed]
+        lines = [json.dumps(self.header)] + [json.dumps(chunk) for chunk in self.chunks]
+        utils.write_file(self.path, "".join(line + "\n" for line in lines).encode('utf-8'), self.fsync)
+        self.file = open(self.path, 'a')
+
+
+    def add_chunk(self, chunk_index, size, filenames, annotations_offset, shard_position=None):
+        """Records a chunk of size plates whose images and annotations are written"""
+        record = {'chunk': chunk_index, 'size': size, 'filenames': filenames,
+            'annotations_offset': annotations_offset, 'shard_position': shard_position}
+        self.chunks.append(record)
+        self.file.write(json.dumps(record) + "\n")
+        if self.fsync:
+            utils.sync_file(self.file)
+        else:
+            self.file.flush()
+
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
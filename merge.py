@@ -0,0 +1,51 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+
+import os
+import argparse
+
+import context
+import annotations
+
+
+def merge_shards(input_path, output_path, annotation_type):
+    """Merges the annotation files of every node of a sharded run into a single annotation file
+        Returns the path of the merged file
+    """
+    annotator = annotations.AnnotatorFactory.get_annotator(annotation_type)
+    input_files = annotator.get_shard_files(input_path)
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+    annotator.merge_annotations(input_files, output_path)
+    return annotator.get_output_file(output_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merges per node annotation files of a sharded run into one dataset annotation file')
+    parser.add_argument('--config', default='configuration.cfg')
+    parser.add_argument('--input', help='Directory with the annotation files of all nodes, output_path by default')
+    parser.add_argument('--output', help='Directory for the merged annotation file, same as input by default')
+    args = parser.parse_args()
+
+    settings = context.Context(args.config).settings.general
+    input_path = args.input if args.input is not None else settings.output_path
+    output_path = args.output if args.output is not None else input_path
+    merged_file = merge_shards(input_path, output_path, settings.annotation_type)
+    print("Annotations merged to {0}".format(merged_file))
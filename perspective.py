@@ -21,9 +21,9 @@
 
 import math
 import random
-import copy
-import ast
+import itertools
 from functools import reduce
+from collections import OrderedDict
 
 import numpy as np
 import cv2
@@ -139,8 +139,67 @@ def get_random_angles(theta_range, phi_range, gamma_range, step):
     return (theta, phi, gamma)
 
 
-def cut_warped_image(warped_image, source_width, source_height, matrix):
-    """Returns a cropped version of the image, containing the minimum size required to contain the image"""
+class WarpCache(object):
+    """Memoizes warp matrices, side length and crop points per (width, height, theta, phi, gamma, scale, fov)"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+
+    def get_warp(self, width, height, theta, phi, gamma, scale, fov):
+        """Returns (matrix, side_length, crop_points, crop_matrix), computing them on a cache miss"""
+        key = (width, height, theta, phi, gamma, scale, fov)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+
+        entry = compute_warp(width, height, theta, phi, gamma, scale, fov)
+        if self.max_size > 0:
+            self.entries[key] = entry
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return entry
+
+
+    def precompute(self, image_sizes, context):
+        """Computes the whole lattice of configured angles for a list of (width, height) image sizes"""
+        settings = context.settings.perspective
+        step = settings.rotation_step
+        lattice = itertools.product(image_sizes,
+            range(settings.theta_range[0], settings.theta_range[1], step),
+            range(settings.phi_range[0], settings.phi_range[1], step),
+            range(settings.gamma_range[0], settings.gamma_range[1], step))
+        for (width, height), theta, phi, gamma in lattice:
+            self.get_warp(width, height, theta, phi, gamma, settings.scale, settings.field_of_view)
+
+
+def get_warp_cache(context, image_sizes=None):
+    """Creates a warp cache from settings, precomputing it if configured and sizes are known"""
+    warp_cache = WarpCache(context.settings.perspective.warp_cache_size)
+    if image_sizes and context.settings.perspective.precompute_warps:
+        warp_cache.precompute(image_sizes, context)
+    return warp_cache
+
+
+def compute_warp(width, height, theta, phi, gamma, scale, fov):
+    """Computes warp matrices, side length and crop points of an image size and set of angles"""
+    matrix, side_length = get_warp_matrix(width, height, theta, phi, gamma, scale, fov)
+    crop_points = get_crop_points(width, height, matrix)
+    crop_matrix = get_crop_matrix(matrix, crop_points)
+    return matrix, side_length, crop_points, crop_matrix
+
+
+def get_crop_matrix(matrix, crop_points):
+    """Returns the warp matrix with the crop offset folded in, it maps directly into the cropped image"""
+    p1 = crop_points[0]
+    translation = np.array([[1, 0, -p1[0]], [0, 1, -p1[1]], [0, 0, 1]], dtype=matrix.dtype)
+    return np.matmul(translation, matrix)
+
+
+def get_crop_points(source_width, source_height, matrix):
+    """Returns the minimum rect [p1, p2] that contains a warped image"""
     # Find coordinates position of warped image
     image_coords = np.array([[
                     [0,0], 
@@ -153,82 +212,97 @@ def cut_warped_image(warped_image, source_width, source_height, matrix):
     # Find the minimum rect bouding box that fits the warped image. p = [x, y]
     p1 = np.min(warped_coords, axis=0).astype(int)
     p2 = np.max(warped_coords, axis=0).astype(int)
-    
+
+    return [p1, p2]
+
+
+def get_warped_size(side_length, crop_points, crop_warp=False):
+    """Returns (width, height) of a warped and cropped image, as warp_image produces it"""
+    p1, p2 = crop_points
+    if crop_warp:
+        return int(min(p2[0], side_length) - p1[0]), int(min(p2[1], side_length) - p1[1])
+    # Cropping slices a (side_length, side_length) image
+    return len(range(side_length)[p1[0]:p2[0]]), len(range(side_length)[p1[1]:p2[1]])
+
+
+def cut_warped_image(warped_image, source_width, source_height, matrix, crop_points=None):
+    """Returns a cropped version of the image, containing the minimum size required to contain the image"""
+    if crop_points is None:
+        crop_points = get_crop_points(source_width, source_height, matrix)
+    p1, p2 = crop_points
+
     # Crop image
     result = warped_image[p1[1]:p2[1], p1[0]:p2[0]]
 
-    return result, [p1, p2]
+    return result, crop_points
 
 
 def warp_bboxes(bboxes, matrix, crop_points=None, rotate_bboxes=False):
     """Re-calculates new bounding boxes based on transformation matrix used for an image"""
-    warped_bboxes = []
-    for bbox in bboxes:
-        bbox_coords = bbox_to_coords(bbox)
-        bbox_points = np.array([[
-            [bbox_coords[0], bbox_coords[1]],
-            [bbox_coords[2], bbox_coords[1]],
-            [bbox_coords[0], bbox_coords[3]],
-            [bbox_coords[2], bbox_coords[3]]
-        ]], dtype='float32')
-
-        # Find the new rectangle bbox that fits the warped bbox
-        warped_coords = cv2.perspectiveTransform(bbox_points, matrix)[0]
-        new_bbox = copy.copy(bbox)
-        if rotate_bboxes:
-            # minAreaRect = (cx,cy),(w,h),angle
-            bbox_rect = cv2.minAreaRect(warped_coords)
-            new_bbox['cx'], new_bbox['cy'] = bbox_rect[0][0], bbox_rect[0][1]
-            new_bbox['w'], new_bbox['h'] = bbox_rect[1][0], bbox_rect[1][1]
-            new_bbox['angle'] = bbox_rect[2]
-        else:
-            # boundingRect = (x1,y1),(w,h)
-            bbox_rect = cv2.boundingRect(warped_coords)
-            new_bbox['w'], new_bbox['h'] = bbox_rect[2], bbox_rect[3]
-            # cx = x1 + w/2, cy = x2 + h/2
-            new_bbox['cx'], new_bbox['cy'] = bbox_rect[0] + (bbox_rect[2]/2), bbox_rect[1] + (bbox_rect[3]/2)
-            new_bbox['angle'] = 0
-        
-        # Apply cropping to bbox if points provided
-        if crop_points:
-            new_bbox['cx'] -= crop_points[0][0]
-            new_bbox['cy'] -= crop_points[0][1]
-        
-        warped_bboxes.append(new_bbox)
-
-    return warped_bboxes
-
-
-def warp_image(image, theta, phi, gamma, scale, fovy, bboxes=None, rotate_bboxes=False):
-    """Changes the perspective of an image according to x,y,z angles"""
+    # Transform the corners of all bboxes in a single call
+    bbox_points = bboxes.get_corners().astype('float32')
+    warped_coords = cv2.perspectiveTransform(bbox_points.reshape(1, -1, 2), matrix).reshape(-1, 4, 2)
+
+    warped_boxes = np.zeros(bboxes.boxes.shape)
+    if rotate_bboxes:
+        # minAreaRect = (cx,cy),(w,h),angle, has to be fitted per bbox
+        for index, bbox_coords in enumerate(warped_coords):
+            (cx, cy), (w, h), angle = cv2.minAreaRect(bbox_coords)
+            warped_boxes[index] = (cx, cy, w, h, angle)
+    else:
+        # Find the new rectangle bbox that fits the warped bbox, same as boundingRect
+        p1 = np.floor(warped_coords.min(axis=1))
+        p2 = np.floor(warped_coords.max(axis=1))
+        size = p2 - p1 + 1
+        warped_boxes[:, 2:4] = size
+        # cx = x1 + w/2, cy = y1 + h/2
+        warped_boxes[:, 0:2] = p1 + (size / 2)
+
+    # Apply cropping to bbox if points provided
+    if crop_points:
+        warped_boxes[:, 0] -= crop_points[0][0]
+        warped_boxes[:, 1] -= crop_points[0][1]
+
+    return type(bboxes)(warped_boxes, bboxes.classes)
+
+
+def warp_image(image, theta, phi, gamma, scale, fovy, bboxes=None, rotate_bboxes=False, warp_cache=None, crop_warp=False, alpha=None):
+    """Changes the perspective of a BGR image according to x,y,z angles, returns (image, alpha, bboxes)
+        Areas outside of the warped image are transparent on the returned alpha mask, alpha=None means opaque
+    """
     height, width, _ = image.shape
-    matrix, side_length = get_warp_matrix(width, height, theta, phi, gamma, scale, fovy) # Compute warp matrix
-    transparent_bg = (0,0,0,0)
-    result_image = image
-    if image.shape[2] == 3:
-        result_image = cv2.cvtColor(image, cv2.COLOR_RGB2RGBA)
-    result_image = cv2.warpPerspective(result_image, matrix, (side_length, side_length), borderValue=transparent_bg) # Do actual image warp
-    result_image, crop_points = cut_warped_image(result_image, image.shape[1], image.shape[0], matrix)
+    # Compute warp matrix, or get it from cache
+    if warp_cache is not None:
+        matrix, side_length, crop_points, crop_matrix = warp_cache.get_warp(width, height, theta, phi, gamma, scale, fovy)
+    else:
+        matrix, side_length, crop_points, crop_matrix = compute_warp(width, height, theta, phi, gamma, scale, fovy)
+    # Color and alpha are warped apart, same pixels as warping a BGRA image with a transparent border
+    if alpha is None:
+        alpha = np.full((height, width), 255, dtype=np.uint8)
+    if crop_warp:
+        # Warp only the region that would be kept after cropping
+        crop_size = get_warped_size(side_length, crop_points, crop_warp)
+        result_image = cv2.warpPerspective(image, crop_matrix, crop_size, borderValue=(0, 0, 0))
+        result_alpha = cv2.warpPerspective(alpha, crop_matrix, crop_size, borderValue=0)
+    else:
+        result_image = cv2.warpPerspective(image, matrix, (side_length, side_length), borderValue=(0, 0, 0)) # Do actual image warp
+        result_alpha = cv2.warpPerspective(alpha, matrix, (side_length, side_length), borderValue=0)
+        result_image, crop_points = cut_warped_image(result_image, width, height, matrix, crop_points)
+        result_alpha, _ = cut_warped_image(result_alpha, width, height, matrix, crop_points)
     result_bboxes = None
     if bboxes: 
         result_bboxes = warp_bboxes(bboxes, matrix, crop_points=crop_points, rotate_bboxes=rotate_bboxes)
 
-    return result_image, result_bboxes
+    return result_image, result_alpha, result_bboxes
 
 
-def warp_image_random(image, bboxes, context):
-    """Changes the perspective viewing angles of an image by a random number"""
-    theta_range = ast.literal_eval(context.getConfig("Perspective", "theta_range"))
-    phi_range   = ast.literal_eval(context.getConfig("Perspective", "phi_range"))
-    gamma_range = ast.literal_eval(context.getConfig("Perspective", "gamma_range"))
-    step = int(context.getConfig("Perspective", "rotation_step"))
-    fov = int(context.getConfig("Perspective", "field_of_view"))
-    scale = float(context.getConfig("Perspective", "scale"))
-    rotate_bboxes = context.getBoolean("Image", "rotate_bboxes")
-    theta, phi, gamma = get_random_angles(theta_range, phi_range, gamma_range, step)
+def warp_image_random(image, bboxes, context, warp_cache=None, alpha=None):
+    """Changes the perspective viewing angles of an image by a random number, returns (image, alpha, bboxes)"""
+    settings = context.settings.perspective
+    theta, phi, gamma = get_random_angles(settings.theta_range, settings.phi_range, settings.gamma_range, settings.rotation_step)
 
-    result_image, result_bboxes = warp_image(image, theta, phi, gamma, scale, fov, bboxes, rotate_bboxes)
-    return result_image, result_bboxes
+    return warp_image(image, theta, phi, gamma, settings.scale, settings.field_of_view,
+        bboxes, context.settings.image.rotate_bboxes, warp_cache, settings.crop_warp, alpha)
 
 
 #region bounding box operations
@@ -18,101 +18,100 @@
 #!/usr/bin/python
 
 import os
-import ast
 import copy
 import cv2
-import rstr
+import random
 import numpy as np
-import PIL.Image, PIL.ImageFont, PIL.ImageDraw
+import assets
+import bboxes
 import perspective
 import utils
 
-RGB_GREEN = (0, 255, 0)
-RGBA_GREEN = (0, 255, 0, 0)
+BGR_GREEN = (0, 255, 0)
 PLATE_ANNOTATION = {'filename': None, 'class': None, 'bboxes': []}
-BBOX_ANNOTATION = {'class': None, 'cx': None, 'cy': None, 'w': None, 'h': None, 'angle': 0}
 SPECIAL_CHARS = ['-']
 
 
 class Plate(object):
-    """Represents a Plate and holds all its attributes"""
-
-    def __init__(self, context, plate_type, template):
-        """Constructor"""
+    """Represents a Plate and holds all its attributes
+        image_data is a BGR array, alpha its uint8 mask once warped (None while the plate is opaque)
+    """
+
+    def __init__(self, context, plate_type, template, registry=None, number_template=None, plate_number=None):
+        """Constructor
+            number_template and plate_number are assigned beforehand to keep numbers unique, drawn at random if None
+            A None template leaves the plate empty, see from_image
+        """
         # Base attributes
         self.context = context
+        self.registry = registry if registry is not None else assets.AssetRegistry(context)
         self.type = plate_type
         self.base_file = None
         self.plate_number = None
         self.bounding_boxes = None
-        self.image_data = None     
-
-        self.__autogenerate(template)
-
-
-    def __autogenerate(self, template):
-        """Generates plate based on template provided"""
-        # Open base image template 
+        self.image_data = None
+        self.alpha = None
+        self.scale_factor = 1 # Scale the plate is rendered at
+
+        if template is not None:
+            self.__autogenerate(template, number_template, plate_number)
+
+
+    @classmethod
+    def from_image(cls, context, plate_type, base_file, plate_number, image_data, bounding_boxes, registry=None):
+        """Creates a plate from an image rendered elsewhere, i.e: by batch rendering"""
+        new_plate = cls(context, plate_type, None, registry)
+        new_plate.base_file = base_file
+        new_plate.plate_number = plate_number
+        new_plate.image_data = image_data
+        new_plate.bounding_boxes = bounding_boxes
+        return new_plate
+
+
+    def __autogenerate(self, template, number_template=None, plate_number=None):
+        """Generates plate based on template provided
+            With render_at_scale the plate is drawn directly at a random scale, random_resize leaves it as it is
+        """
+        # Choose base image template and texts
         self.base_file = utils.get_random_item(template["base-image"])
-        image_path = os.path.join(self.context.getConfig("General", "templates_path"), self.base_file)
-        self.image_data = PIL.Image.open(image_path)
-
-        
-        # Generate & draw plate number
-        plate_template = utils.get_random_item(template["plate-number"])
-        self.plate_number, self.bounding_boxes = self.draw_regex(plate_template)
-
-        # Draw extra text, if any
+        if number_template is None:
+            plate_template = utils.get_random_item(template["plate-number"])
+        else:
+            plate_template = template["plate-number"][number_template]
+        if plate_number is None:
+            plate_number = self.registry.get_sampler(plate_template["regex"]).sample()
+        extra_texts = []
         if "extra-text" in template.keys():
             for text_template in template["extra-text"]:
-                self.draw_regex(text_template)
+                extra_texts.append((text_template, self.registry.get_sampler(text_template["regex"]).sample()))
+
+        # Scale is drawn at the same point of the random sequence random_resize would draw it
+        if self.context.settings.image.render_at_scale:
+            self.scale_factor = utils.get_random_item(self.context.settings.image.plate_scales)
+        self.image_data = self.registry.get_image_array(self.base_file, self.scale_factor)
 
-        # Will use CV2 for the rest of image operations
-        self.image_data = self.pil_to_cv2(self.image_data)
+        # Draw plate number and extra text, if any
+        self.plate_number, self.bounding_boxes = self.draw_regex(plate_template, plate_number)
+        for text_template, text in extra_texts:
+            self.draw_regex(text_template, text)
 
-        # Generate plate bbox, add it to the list
-        w = self.image_data.shape[1]
-        h = self.image_data.shape[0]
+        # Generate plate bbox from the full size of the base image, add it to the list
+        w, h = self.registry.load_image(self.base_file).size
         cx = (w / 2)
         cy = (h / 2)
-        plate_bbox = copy.copy(BBOX_ANNOTATION)
-        plate_bbox['class'] = self.type
-        plate_bbox['cx'], plate_bbox['cy'], plate_bbox['w'], plate_bbox['h'] = cx, cy, w, h
-        self.bounding_boxes.append(plate_bbox)
-
-
-    def draw_regex(self, text_template):
-        """Draws text on plate image based on a template object"""
-        draw = PIL.ImageDraw.Draw(self.image_data)
-        font_path = os.path.join(self.context.getConfig("General", "templates_path"), text_template["font"])
-        text_font = PIL.ImageFont.truetype(font_path, text_template["size"])
-        text = rstr.xeger(text_template["regex"])
-        ascent, descent = text_font.getmetrics()
-        # Draw each character and calculate its bounding box
-        bbox_padding = ast.literal_eval(self.context.getConfig("Image", "bbox_padding"))
-        bounding_boxes = []
-        last_pos_x = 0
-        for char in text:
-            (width, baseline), (offset_x, offset_y) = text_font.font.getsize(char)
-            height = ascent - offset_y # Some fonts can contain an offset in height (accounted for ascent)
-            char_pos_x = text_template["position"][0] + last_pos_x
-            char_pos_y = text_template["position"][1]
-            if char == '-': # Dash character is offsetted further
-                char_pos_x += offset_x / 2
-                char_pos_y += offset_y / 2
-            # Draw character in desired position
-            draw.text((char_pos_x - offset_x, char_pos_y - offset_y), char, font=text_font, fill=text_template["color"])
-            new_bbox = copy.copy(BBOX_ANNOTATION)
-            x1 = (char_pos_x - bbox_padding[0])
-            y1 = (char_pos_y - bbox_padding[1])
-            x2 = (char_pos_x + width + bbox_padding[0])
-            y2 = (char_pos_y + height + bbox_padding[1])
-            new_bbox['class'] = char
-            new_bbox['cx'], new_bbox['cy'], new_bbox['w'], new_bbox['h'] = perspective.coords_to_bbox([x1,y1,x2,y2])
-            bounding_boxes.append(new_bbox)
-            last_pos_x = last_pos_x + width + text_template["spacing"]
-
-        return text, bounding_boxes
+        self.bounding_boxes.append(self.type, cx * self.scale_factor, cy * self.scale_factor, w * self.scale_factor, h * self.scale_factor)
+
+
+    def draw_regex(self, text_template, text=None):
+        """Draws text on plate image based on a template object, random text matching its regex if None"""
+        if text is None:
+            text = self.registry.get_sampler(text_template["regex"]).sample()
+        ink = self.registry.get_ink(text_template["color"])
+        draws, bbox_classes, bbox_coords = layout_text(self.registry, text_template, text, self.scale_factor)
+        for glyph, draw_position in draws:
+            glyph.draw(self.image_data, draw_position, ink)
+
+        return text, bboxes.BoundingBoxes.from_coords(bbox_classes, bbox_coords).scale(self.scale_factor)
 
 
     def draw_all_bboxes(self):
@@ -120,7 +119,7 @@ class Plate(object):
         assert(len(self.bounding_boxes) > 0)
 
         result_image = copy.copy(self.image_data)
-        for bbox in self.bounding_boxes:
+        for bbox in self.bounding_boxes.to_dicts():
             self.draw_bbox(result_image, bbox)
 
         return result_image
@@ -135,7 +134,10 @@ class Plate(object):
 
 
     def random_resize(self):
-        plate_scales = ast.literal_eval(self.context.getConfig('Image', 'plate_scales'))
+        """Resizes plate by a random scale factor, plates rendered at scale already have their final size"""
+        if self.context.settings.image.render_at_scale:
+            return
+        plate_scales = self.context.settings.image.plate_scales
         scale_factor = utils.get_random_item(plate_scales)
         self.resize_image(scale_factor)
         self.resize_bboxes(scale_factor)
@@ -149,28 +151,30 @@ class Plate(object):
 
     def resize_bboxes(self, scale_factor):
         """Re-calculates bounding boxes according to a scale factor"""
-        for bbox in self.bounding_boxes:
-            bbox['cx'] = bbox['cx'] * scale_factor
-            bbox['cy'] = bbox['cy'] * scale_factor
-            bbox['w'] = bbox['w'] * scale_factor
-            bbox['h'] = bbox['h'] * scale_factor
+        self.bounding_boxes = self.bounding_boxes.scale(scale_factor)
 
 
     def save_image(self, path=None):
         """Saves plate image to disk"""
-        savePath = path if path is not None else self.context.getConfig("General", "output_path")
+        savePath = path if path is not None else self.context.settings.general.output_path
         savePath = os.path.join(savePath, self.get_filename())
-        savePath = savePath.lower()
+        utils.write_file(savePath, self.encode_image(), self.context.settings.general.fsync)
+        return savePath
+
+
+    def encode_image(self):
+        """Returns plate image encoded in memory, as it would be saved to disk"""
+        return utils.encode_image(os.path.splitext(self.get_filename())[1], self.get_output_image())
+
+
+    def get_output_image(self):
+        """Returns plate image as it is saved: BGR, alpha is not saved, with bounding boxes if configured"""
         save_data = self.image_data
-        # Eliminate alpha channel to optimize storage
-        if save_data.shape[2] == 4:
-            save_data = cv2.cvtColor(save_data, cv2.COLOR_RGBA2RGB)
         # Draw bounding boxes if needed
-        if self.context.getBoolean("Image", "draw_bboxes"):
+        if self.context.settings.image.draw_bboxes:
             save_data = self.draw_all_bboxes()
 
-        cv2.imwrite(savePath, save_data)
-        return savePath
+        return save_data
 
 
     def get_annotation(self):
@@ -178,24 +182,117 @@ class Plate(object):
         annotation = copy.copy(PLATE_ANNOTATION)
         annotation['filename'] = self.get_filename()
         annotation['class'] = self.type
-                
-        for bbox in self.bounding_boxes:
-            annotation['bboxes'].append(copy.copy(bbox))
+        annotation['bboxes'] = self.bounding_boxes.to_dicts()
 
         return annotation
 
 
 #region Utility functions
-    def pil_to_cv2(self, image):
-        return cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-
-
     def get_color(self):
-        if self.image_data.shape[2] == 3:
-            return RGB_GREEN
-        else:
-            return RGBA_GREEN
+        return BGR_GREEN
 
     def get_filename(self):
-        return "{0}_{1}.jpg".format(self.type, self.plate_number)
-#endregion
\ No newline at end of file
+        return get_filename(self.type, self.plate_number)
+
+    def get_plates(self):
+        """Returns the plates shown on the image, see scene.Scene"""
+        return [self]
+#endregion
+
+
+def layout_text(registry, text_template, text, scale_factor=1):
+    """Places each character of a text, returns (glyph, draw position) pairs and the classes and coords of their bounding boxes
+        Bounding boxes are laid out at template size. A scale factor other than 1 returns glyphs of the font scaled by it,
+        drawn at scaled positions, so the text is rendered directly at that scale
+    """
+    font_file, font_size = text_template["font"], text_template["size"]
+    ascent, descent = registry.get_font(font_file, font_size).getmetrics()
+    bbox_padding = registry.bbox_padding
+    draws = []
+    bbox_classes = []
+    bbox_coords = []
+    last_pos_x = 0
+    for char in text:
+        (width, baseline), (offset_x, offset_y) = registry.get_glyph(font_file, font_size, char).get_metrics()
+        height = ascent - offset_y # Some fonts can contain an offset in height (accounted for ascent)
+        char_pos_x = text_template["position"][0] + last_pos_x
+        char_pos_y = text_template["position"][1]
+        if char == '-': # Dash character is offsetted further
+            char_pos_x += offset_x / 2
+            char_pos_y += offset_y / 2
+        # Character is drawn in this position, using a pre-rasterized glyph
+        draw_position = (char_pos_x - offset_x, char_pos_y - offset_y)
+        if scale_factor != 1:
+            draw_position = (draw_position[0] * scale_factor, draw_position[1] * scale_factor)
+        draws.append((registry.get_glyph(font_file, font_size * scale_factor, char, draw_position), draw_position))
+        x1 = (char_pos_x - bbox_padding[0])
+        y1 = (char_pos_y - bbox_padding[1])
+        x2 = (char_pos_x + width + bbox_padding[0])
+        y2 = (char_pos_y + height + bbox_padding[1])
+        bbox_classes.append(char)
+        bbox_coords.append([x1, y1, x2, y2])
+        last_pos_x = last_pos_x + width + text_template["spacing"]
+
+    return draws, bbox_classes, bbox_coords
+
+
+class PlateNumberIndex(object):
+    """Assigns plate types and numbers ahead of rendering, so no two plates of a run share a file name
+        Types whose numbers run out are left out of later draws, an error is raised once every type is exhausted
+    """
+
+    # Attempts to find an unused number before a plate type is considered exhausted
+    MAX_ATTEMPTS = 1000
+
+    def __init__(self, templates, registry, seed):
+        self.templates = templates
+        self.registry = registry
+        self.random = random.Random("{0}-numbers".format(seed))
+        self.available = list(templates.keys())
+        self.filenames = set()
+        self.counts = dict((plate_type, 0) for plate_type in templates)
+
+
+    def add(self, filename):
+        """Marks a file name as used, returns False if it already was"""
+        if filename in self.filenames:
+            return False
+        self.filenames.add(filename)
+        return True
+
+
+    def assign(self, count):
+        """Draws a batch of (plate_type, number_template, plate_number) assignments with unused file names"""
+        assignments = []
+        while len(assignments) < count:
+            if not self.available:
+                raise ValueError("Plate numbers exhausted after {0} plates, all templates ran out of unique numbers".format(len(self.filenames)))
+            plate_type = self.available[self.random.randrange(len(self.available))]
+            assignment = self.draw(plate_type)
+            if assignment is None:
+                self.available.remove(plate_type)
+            else:
+                assignments.append(assignment)
+        return assignments
+
+
+    def draw(self, plate_type):
+        """Draws an unused number for a plate type, None if the type is exhausted"""
+        number_templates = self.templates[plate_type]["plate-number"]
+        samplers = [self.registry.get_sampler(number_template["regex"]) for number_template in number_templates]
+        sizes = [sampler.size for sampler in samplers]
+        if None not in sizes and self.counts[plate_type] >= sum(sizes):
+            return None
+
+        for _ in range(self.MAX_ATTEMPTS):
+            number_template = self.random.randrange(len(samplers))
+            plate_number = samplers[number_template].sample(self.random)
+            if self.add(get_filename(plate_type, plate_number)):
+                self.counts[plate_type] += 1
+                return plate_type, number_template, plate_number
+        return None
+
+
+def get_filename(plate_type, plate_number):
+    """Returns the file name of a plate, file names are unique per type and number"""
+    return "{0}_{1}.jpg".format(plate_type, plate_number).lower()
\ No newline at end of file
@@ -0,0 +1,155 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+# Histogram bucket b holds timings in [2^b - 1, 2^(b+1) - 1) microseconds, last one is open ended (> ~35 minutes)
+HISTOGRAM_BUCKETS = 32
+REPORT_NAME = "run_report"
+
+
+class Profiler(object):
+    """Collects per-stage timing histograms and counters
+        State can be sent from worker processes and merged into the main process profiler
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+
+
+    @contextmanager
+    def __timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+
+    def stage(self, name):
+        """Context manager timing a pipeline stage, does nothing when disabled"""
+        if not self.enabled:
+            return NULL_STAGE
+        return self.__timer(name)
+
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        bucket = min(HISTOGRAM_BUCKETS - 1, int(math.log2(seconds * 1e6 + 1)))
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = {'count': 0, 'total': 0.0, 'max': 0.0, 'histogram': [0] * HISTOGRAM_BUCKETS}
+                self.stages[name] = stage
+            stage['count'] += 1
+            stage['total'] += seconds
+            stage['max'] = max(stage['max'], seconds)
+            stage['histogram'][bucket] += 1
+
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def pop_state(self):
+        """Returns collected stages and counters and resets them, None when disabled"""
+        if not self.enabled:
+            return None
+        with self.lock:
+            state = (self.stages, self.counters)
+            self.stages, self.counters = {}, {}
+        return state
+
+
+    def merge(self, state):
+        """Adds stages and counters collected by another profiler"""
+        if not self.enabled or state is None:
+            return
+        stages, counters = state
+        with self.lock:
+            for name, other in stages.items():
+                stage = self.stages.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0, 'histogram': [0] * HISTOGRAM_BUCKETS})
+                stage['count'] += other['count']
+                stage['total'] += other['total']
+                stage['max'] = max(stage['max'], other['max'])
+                stage['histogram'] = [a + b for a, b in zip(stage['histogram'], other['histogram'])]
+            for name, value in counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+
+
+    def get_report(self, **run_info):
+        """Returns a JSON serializable report, latency percentiles are estimated from the histograms"""
+        report = dict(run_info)
+        report['stages'] = {}
+        for name, stage in sorted(self.stages.items()):
+            report['stages'][name] = {
+                'count': stage['count'],
+                'total_s': stage['total'],
+                'mean_ms': stage['total'] / stage['count'] * 1000,
+                'p50_ms': get_percentile(stage['histogram'], 0.5),
+                'p99_ms': get_percentile(stage['histogram'], 0.99),
+                'max_ms': stage['max'] * 1000,
+                'histogram_us': stage['histogram']
+            }
+        report['counters'] = dict(sorted(self.counters.items()))
+        return report
+
+
+    def save_report(self, path, **run_info):
+        with open(path, 'w') as f:
+            json.dump(self.get_report(**run_info), f, indent=4)
+
+
+class NullStage(object):
+    """Context manager used by disabled profilers"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = NullStage()
+DISABLED = Profiler(enabled=False)
+
+
+def get_percentile(histogram, percentile):
+    """Returns the upper bound (ms) of the histogram bucket that holds a percentile"""
+    total = sum(histogram)
+    if total == 0:
+        return 0.0
+    target = percentile * total
+    accumulated = 0
+    for bucket, bucket_count in enumerate(histogram):
+        accumulated += bucket_count
+        if accumulated >= target:
+            return (2 ** (bucket + 1) - 1) / 1000.0
+    return (2 ** len(histogram) - 1) / 1000.0
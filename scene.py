@@ -20,30 +20,86 @@
 import os
 import cv2
 import random
-import copy
-import ast
+import numpy as np
+from collections import OrderedDict
 
+import bboxes
+import plate
 import utils
 
+# Side (px) of the cells used to track the free area of a background when placing several plates
+PLACEMENT_CELL_SIZE = 4
 
-def get_random_bg(context):
+
+class BackgroundCache(object):
+    """Keeps decoded and resized backgrounds in memory, least recently used ones are evicted
+        bg_cache_size is the budget of all worker processes, each cache holds its share of it
+    """
+
+    def __init__(self, context, workers=1):
+        self.bg_path = context.settings.general.backgrounds_path
+        self.bg_list = os.listdir(self.bg_path)
+        self.sizes = context.settings.image.bg_sizes
+        self.max_bytes = int(context.settings.image.bg_cache_size * 1024 * 1024 / workers)
+        self.used_bytes = 0
+        self.images = OrderedDict()
+
+
+    def get_random_bg(self):
+        """Returns a copy of a random background, safe to draw on"""
+        selected_bg, size = self.get_random_key()
+        return self.get_bg(selected_bg, size).copy()
+
+
+    def get_random_key(self):
+        """Draws a random (background file, size) pair without loading it"""
+        selected_bg = self.bg_list[random.randrange(len(self.bg_list))]
+        size = utils.get_random_item(self.sizes)
+        return selected_bg, size
+
+
+    def get_bg(self, selected_bg, size):
+        """Returns the shared background for a file and size, loading it on a cache miss"""
+        key = (selected_bg, tuple(size))
+        bg_image = self.images.get(key)
+        if bg_image is not None:
+            self.images.move_to_end(key)
+            return bg_image
+
+        bg_image = load_bg(os.path.join(self.bg_path, selected_bg), size)
+        if bg_image.nbytes <= self.max_bytes:
+            self.images[key] = bg_image
+            self.used_bytes += bg_image.nbytes
+            while self.used_bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.used_bytes -= evicted.nbytes
+        return bg_image
+
+
+def load_bg(path, size):
+    """Reads a background image as BGR and resizes it"""
+    bg_image = cv2.imread(path, cv2.IMREAD_COLOR)
+
+    # Resize image according to the configured size
+    bg_image = utils.resize_image(bg_image, size)
+
+    return bg_image
+
+
+def get_random_bg(context, bg_cache=None):
     """Returns a random background image from configured path"""
+    if bg_cache is not None:
+        return bg_cache.get_random_bg()
 
-    bg_path = context.getConfig('General', 'backgrounds_path')
+    bg_path = context.settings.general.backgrounds_path
     bg_list = os.listdir(bg_path)
     selected_bg = bg_list[random.randrange(len(bg_list))]
-    bg_image = cv2.imread(os.path.join(bg_path, selected_bg))
 
     # Resize image according to the list of configured sizes
-    sizes = ast.literal_eval(context.getConfig('Image', 'bg_sizes'))
+    sizes = context.settings.image.bg_sizes
     size = utils.get_random_item(sizes)
-    bg_image = utils.resize_image(bg_image, size)
 
-    # Add alpha channel to image if not present, this is to add foreground
-    if bg_image.shape[2] == 3:
-        bg_image = cv2.cvtColor(bg_image, cv2.COLOR_RGB2RGBA)
-    
-    return bg_image
+    return load_bg(os.path.join(bg_path, selected_bg), size)
 
 
 def get_random_position(image_width, image_height, bg_width, bg_height):
@@ -63,26 +119,134 @@ def get_random_position(image_width, image_height, bg_width, bg_height):
     return x1, y1, x2, y2
 
 
-def add_backgroud(image, bboxes, context):
-    result_image = get_random_bg(context)
-    x1, y1, x2, y2 = get_random_position(image.shape[1], image.shape[0], result_image.shape[1], result_image.shape[0])
+def composite(image, alpha, background, x1, y1):
+    """Blends a BGR image into a BGR background at (x1, y1) through its alpha mask, in place
+        alpha=None copies the image as it is opaque
+    """
+    height, width = image.shape[:2]
+    roi = background[y1:y1 + height, x1:x1 + width]
+    if alpha is None:
+        roi[...] = image
+        return background
+
+    # fg * a + bg * (255 - a) fits in 16 bits, alpha is broadcast to each color channel
+    alpha = alpha[:, :, np.newaxis].astype(np.uint16)
+    blend = image * alpha
+    np.subtract(255, alpha, out=alpha)
+    blend += roi * alpha
+
+    # Exact integer division by 255: x // 255 == (x + 1 + (x >> 8)) >> 8
+    blend += 1 + (blend >> 8)
+    blend >>= 8
+    roi[...] = blend
+
+    return background
+
+
+def add_backgroud(image, alpha, bboxes, context, bg_cache=None, background=None, position=None):
+    """Composites a BGR image and its alpha mask over a random background, or over the provided background buffer
+        position is the (x1, y1) top left corner of the image, random if None
+    """
+    result_image = background if background is not None else get_random_bg(context, bg_cache)
+    if position is None:
+        x1, y1, x2, y2 = get_random_position(image.shape[1], image.shape[0], result_image.shape[1], result_image.shape[0])
+    else:
+        x1, y1 = position
     
     # Add images by alpha channel
-    alpha_image = image[:, :, 3] / 255.0
-    alpha_bg = 1.0 - alpha_image
-    for channel in range(0, 3):
-        result_image[y1:y2, x1:x2, channel] = (alpha_image * image[:, :, channel] + alpha_bg * result_image[y1:y2, x1:x2, channel])
+    composite(image, alpha, result_image, x1, y1)
 
     # Modify bounding boxes to match new position within the image
     result_bboxes = None
     if bboxes:
-        result_bboxes = []
-        for bbox in bboxes:
-            new_bbox = copy.copy(bbox)
-            new_bbox['cx'] += x1
-            new_bbox['cy'] += y1
-            result_bboxes.append(new_bbox)
+        result_bboxes = bboxes.translate(x1, y1)
 
     return result_image, result_bboxes
 
 
+class OccupancyGrid(object):
+    """Tracks the area of a background taken by plates on a grid of cells
+        Free positions of a rectangle are found for the whole grid at once, from a summed area table
+    """
+
+    def __init__(self, width, height, cell_size=PLACEMENT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.occupied = np.zeros((height // cell_size, width // cell_size), dtype=np.int32)
+
+
+    def place(self, width, height):
+        """Takes a random free (x1, y1) position for a width x height rectangle, None if it does not fit anywhere"""
+        # Rectangles take one cell more than their size, so they can start anywhere within their first cell
+        cells_x = (width + 2 * self.cell_size - 2) // self.cell_size
+        cells_y = (height + 2 * self.cell_size - 2) // self.cell_size
+        rows, cols = self.occupied.shape
+        if cells_x > cols or cells_y > rows:
+            return None
+
+        # Taken cells within the rectangle at every cell position
+        table = np.zeros((rows + 1, cols + 1), dtype=np.int32)
+        np.cumsum(np.cumsum(self.occupied, axis=0), axis=1, out=table[1:, 1:])
+        taken = table[cells_y:, cells_x:] - table[:-cells_y, cells_x:] - table[cells_y:, :-cells_x] + table[:-cells_y, :-cells_x]
+        free = np.flatnonzero(taken == 0)
+        if len(free) == 0:
+            return None
+
+        row, col = divmod(int(free[random.randrange(len(free))]), taken.shape[1])
+        self.occupied[row:row + cells_y, col:col + cells_x] = 1
+        x1 = col * self.cell_size + random.randrange(self.cell_size)
+        y1 = row * self.cell_size + random.randrange(self.cell_size)
+        return x1, y1
+
+
+class Scene(plate.Plate):
+    """Image of several plates over one background, saved and annotated as a plate with the boxes of all of them
+        File name, type and number are the ones of its first plate, plates holds each plate with its boxes on the scene
+    """
+
+    def __init__(self, context, plates, image_data, bounding_boxes):
+        first_plate = plates[0]
+        super(Scene, self).__init__(context, first_plate.type, None, first_plate.registry)
+        self.base_file = first_plate.base_file
+        self.plate_number = first_plate.plate_number
+        self.image_data = image_data
+        self.bounding_boxes = bounding_boxes
+        self.plates = plates
+
+
+    def get_plates(self):
+        return self.plates
+
+
+    def get_annotation(self):
+        """Creates a JSON annotation of the scene, the class and bboxes of each of its plates"""
+        return {
+            'filename': self.get_filename(),
+            'plates': [{'class': scene_plate.type, 'bboxes': scene_plate.bounding_boxes.to_dicts()} for scene_plate in self.plates]
+        }
+
+
+def compose_scene(plates, background, context):
+    """Composites warped plates over a background without overlapping each other, in order
+        Returns the scene and the plates that did not fit on it
+    """
+    grid = OccupancyGrid(background.shape[1], background.shape[0])
+    placed = []
+    remaining = []
+    scene_bboxes = bboxes.BoundingBoxes()
+    for new_plate in plates:
+        height, width = new_plate.image_data.shape[:2]
+        position = grid.place(width, height)
+        if position is None:
+            if not placed and not remaining:
+                raise ValueError("Plate of {0}x{1} does not fit on a {2}x{3} background".format(
+                    width, height, background.shape[1], background.shape[0]))
+            remaining.append(new_plate)
+            continue
+
+        composite(new_plate.image_data, new_plate.alpha, background, *position)
+        new_plate.bounding_boxes = new_plate.bounding_boxes.translate(*position)
+        new_plate.image_data, new_plate.alpha = None, None
+        scene_bboxes.extend(new_plate.bounding_boxes)
+        placed.append(new_plate)
+
+    return Scene(context, placed, background, scene_bboxes), remaining
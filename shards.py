@@ -0,0 +1,184 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import io
+import os
+import json
+import tarfile
+
+import utils
+
+SHARD_NAME = "shard-{0:05d}.tar"
+NODE_SHARD_NAME = "shard-{1:05d}-{0:05d}.tar"
+INDEX_EXTENSION = ".idx"
+TAR_BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class ShardWriter(object):
+    """Packs encoded images and their annotations into tar shards of a fixed number of records
+        Each shard has an index file with one line per record: name, image offset, image size, annotation offset, annotation size
+        Nodes of a sharded run prefix shard names with their shard index, so all shards can be copied to one place
+    """
+
+    def __init__(self, output_path, shard_size, node_index=None, fsync=False):
+        self.output_path = output_path
+        self.fsync = fsync
+        self.shard_size = shard_size
+        self.shard_name = SHARD_NAME if node_index is None else NODE_SHARD_NAME
+        self.node_index = node_index
+        self.shard_index = 0
+        self.shard_paths = []
+        self.tar = None
+        self.index = None
+        self.records = 0
+
+
+    def write(self, filename, image_data, annotation):
+        """Adds an encoded image and its annotation as a record, opens a new shard when the current one is full"""
+        if self.tar is None or self.records >= self.shard_size:
+            self.open_shard()
+
+        name, _ = os.path.splitext(filename)
+        image_offset = self.add_member(filename, image_data)
+        annotation_data = json.dumps(annotation).encode('utf-8')
+        annotation_offset = self.add_member(name + ".json", annotation_data)
+        self.index.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(filename,
+            image_offset, len(image_data), annotation_offset, len(annotation_data)))
+        self.records += 1
+
+
+    def add_member(self, name, data):
+        """Adds a file to the current shard, returns the offset of its data"""
+        member = tarfile.TarInfo(name)
+        member.size = len(data)
+        self.tar.addfile(member, io.BytesIO(data))
+        # Data is followed by padding up to the next block
+        padded_size = -(-member.size // TAR_BLOCK_SIZE) * TAR_BLOCK_SIZE
+        return self.tar.offset - padded_size
+
+
+    def open_shard(self):
+        self.close_shard()
+        shard_path = os.path.join(self.output_path, self.shard_name.format(self.shard_index, self.node_index))
+        self.tar = tarfile.open(shard_path, 'w', format=tarfile.USTAR_FORMAT)
+        self.index = open(shard_path + INDEX_EXTENSION, 'w')
+        self.shard_paths.append(shard_path)
+        self.shard_index += 1
+        self.records = 0
+
+
+    def get_position(self):
+        """Flushes written records and returns where the next one goes: [shard number, records, shard size, index size]"""
+        if self.tar is None:
+            return None
+        self.tar.fileobj.flush()
+        self.index.flush()
+        if self.fsync:
+            utils.sync_file(self.tar.fileobj)
+            utils.sync_file(self.index)
+        return [self.shard_index - 1, self.records, self.tar.offset, self.index.tell()]
+
+
+    def resume(self, position):
+        """Reopens a shard at a position returned by get_position, records and shards written after it are removed"""
+        shard_number, records, shard_size, index_size = position
+        shard_path = os.path.join(self.output_path, self.shard_name.format(shard_number, self.node_index))
+        with open(shard_path + INDEX_EXTENSION, 'r+b') as f:
+            f.truncate(index_size)
+        with open(shard_path, 'r+b') as f:
+            # Appending needs the end of archive marker right after the last kept record
+            f.truncate(shard_size)
+            f.seek(shard_size)
+            f.write(tarfile.NUL * (2 * TAR_BLOCK_SIZE))
+        stale_number = shard_number + 1
+        stale_path = os.path.join(self.output_path, self.shard_name.format(stale_number, self.node_index))
+        while os.path.exists(stale_path):
+            os.remove(stale_path)
+            if os.path.exists(stale_path + INDEX_EXTENSION):
+                os.remove(stale_path + INDEX_EXTENSION)
+            stale_number += 1
+            stale_path = os.path.join(self.output_path, self.shard_name.format(stale_number, self.node_index))
+
+        self.tar = tarfile.open(shard_path, 'a', format=tarfile.USTAR_FORMAT)
+        self.index = open(shard_path + INDEX_EXTENSION, 'a')
+        self.shard_paths.append(shard_path)
+        self.shard_index = shard_number + 1
+        self.records = records
+
+
+    def close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.index.close()
+        if self.fsync:
+            shard_path = self.shard_paths[-1]
+            utils.sync_path(shard_path)
+            utils.sync_path(shard_path + INDEX_EXTENSION)
+        self.tar = None
+        self.index = None
+
+
+    def close(self):
+        """Closes the current shard, shards and indexes are complete after this"""
+        self.close_shard()
+
+
+class ShardReader(object):
+    """Reads records of a shard, sequentially or by position using its index"""
+
+    def __init__(self, shard_path):
+        self.shard_path = shard_path
+        self.entries = []
+        with open(shard_path + INDEX_EXTENSION) as index:
+            for line in index:
+                filename, image_offset, image_size, annotation_offset, annotation_size = line.rstrip('\n').split('\t')
+                self.entries.append((filename, int(image_offset), int(image_size), int(annotation_offset), int(annotation_size)))
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __iter__(self):
+        """Yields (filename, encoded image, annotation) in the order they were written"""
+        with tarfile.open(self.shard_path, 'r') as tar:
+            image = None
+            for member in tar:
+                data = tar.extractfile(member).read()
+                if member.name.endswith(".json"):
+                    yield image[0], image[1], json.loads(data.decode('utf-8'))
+                else:
+                    image = (member.name, data)
+
+
+    def get_record(self, position):
+        """Returns (filename, encoded image, annotation) of a record by its position on the shard"""
+        filename, image_offset, image_size, annotation_offset, annotation_size = self.entries[position]
+        with open(self.shard_path, 'rb') as shard:
+            shard.seek(image_offset)
+            image_data = shard.read(image_size)
+            shard.seek(annotation_offset)
+            annotation = json.loads(shard.read(annotation_size).decode('utf-8'))
+        return filename, image_data, annotation
+
+
+def get_shard_paths(path):
+    """Returns the sorted list of shards on a directory"""
+    return sorted(os.path.join(path, f) for f in os.listdir(path) if f.startswith("shard-") and f.endswith(".tar"))
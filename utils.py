@@ -16,12 +16,14 @@
 
 #######################################################################
 #!/usr/bin/python
+import os
 import cv2
 import random
+import tempfile
 
 def get_random_item(collection):
-    """Returns a random item from a list or dict"""
-    if isinstance(collection, list):
+    """Returns a random item from a list, tuple or dict"""
+    if isinstance(collection, (list, tuple)):
         index = random.randrange(len(collection))
         return collection[index]
     elif isinstance(collection, dict):
@@ -36,6 +38,18 @@ def rescale_image(image, scale_factor):
     result = cv2.resize(image, None, fx=scale_factor, fy=scale_factor, interpolation=interpol)
     return result
 
+
+def get_node_filename(name, extension, shard_index=0, shard_count=1):
+    """Returns the file name of a node output, i.e: annotations-00001-of-00004.csv, plain name.extension on single node runs"""
+    if shard_count == 1:
+        return "{0}.{1}".format(name, extension)
+    return "{0}-{1:05d}-of-{2:05d}.{3}".format(name, shard_index, shard_count, extension)
+
+
+def get_scaled_size(width, height, scale_factor):
+    """Returns (width, height) of an image scaled by a factor, rounded the same way as cv2.resize"""
+    return (int(round(width * scale_factor)), int(round(height * scale_factor)))
+
     
 def resize_image(image, size):
     """Resize image to a specific size [width, height]"""
@@ -44,4 +58,48 @@ def resize_image(image, size):
     else:
         interpol = cv2.INTER_CUBIC
     result = cv2.resize(image, (size[0], size[1]), interpolation=interpol)
-    return result
\ No newline at end of file
+    return result
+
+
+def encode_image(extension, image):
+    """Encodes an image in memory in the format of a file extension i.e: .jpg"""
+    success, encoded = cv2.imencode(extension, image)
+    if not success:
+        raise IOError("Could not encode image as {0}".format(extension))
+    return encoded.tobytes()
+
+
+def write_image(path, image, fsync=False):
+    """Encodes and writes an image atomically, readers never see a partial file. Returns bytes written"""
+    return write_file(path, encode_image(os.path.splitext(path)[1], image), fsync)
+
+
+def write_file(path, data, fsync=False):
+    """Writes bytes to a temporary file on the same directory and moves it to its final path. Returns bytes written
+        With fsync the data is on disk before the move, a crash never leaves a partial file on the final path
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            if fsync:
+                sync_file(f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return len(data)
+
+
+def sync_file(f):
+    """Flushes an open file and its data to disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+
+def sync_path(path):
+    """Flushes the data of a closed file to disk"""
+    with open(path, 'r+b') as f:
+        os.fsync(f.fileno())
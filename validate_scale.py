@@ -0,0 +1,131 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import sys
+import time
+import argparse
+
+import numpy as np
+
+import plate
+import context
+import jsonutil
+import generator
+import utils
+
+DEFAULT_PLATES = 500
+PIXEL_TOLERANCE = 16
+METRICS = ['mean_abs_diff', 'max_abs_diff', 'changed_pixels', 'box_offset', 'box_iou']
+
+
+def render_plate(appContext, templates, registry, seed, index):
+    """Renders and resizes a random plate, same random choices for the same seed and index on both render modes"""
+    generator.seed_random(seed, index)
+    plate_type = utils.get_random_item(templates)
+    new_plate = plate.Plate(appContext, plate_type, templates[plate_type], registry)
+    new_plate.random_resize()
+    return new_plate
+
+
+def get_iou(coords, other_coords):
+    """Returns the intersection over union of each pair of (x1, y1, x2, y2) boxes"""
+    x1 = np.maximum(coords[:, 0], other_coords[:, 0])
+    y1 = np.maximum(coords[:, 1], other_coords[:, 1])
+    x2 = np.minimum(coords[:, 2], other_coords[:, 2])
+    y2 = np.minimum(coords[:, 3], other_coords[:, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area = (coords[:, 2] - coords[:, 0]) * (coords[:, 3] - coords[:, 1])
+    other_area = (other_coords[:, 2] - other_coords[:, 0]) * (other_coords[:, 3] - other_coords[:, 1])
+    return intersection / (area + other_area - intersection)
+
+
+def compare_plates(reference, candidate, tolerance=PIXEL_TOLERANCE):
+    """Returns pixel and box differences of a plate rendered at scale against the same plate rendered and resized"""
+    assert(reference.get_filename() == candidate.get_filename())
+    assert(reference.image_data.shape == candidate.image_data.shape)
+    assert(len(reference.bounding_boxes) == len(candidate.bounding_boxes))
+
+    diff = np.abs(reference.image_data.astype(np.int16) - candidate.image_data.astype(np.int16))
+    coords = reference.bounding_boxes.get_coords()
+    other_coords = candidate.bounding_boxes.get_coords()
+    return {
+        'mean_abs_diff': float(diff.mean()),
+        'max_abs_diff': float(diff.max()),
+        'changed_pixels': float((diff > tolerance).any(axis=2).mean()),
+        'box_offset': float(np.abs(coords - other_coords).max()),
+        'box_iou': float(get_iou(coords, other_coords).min())
+    }
+
+
+def validate(config_path, templates_path, count, seed, tolerance=PIXEL_TOLERANCE):
+    """Renders the same plates both ways, returns their differences and the render time (s) of each mode"""
+    templates = jsonutil.deserializeJson(templates_path)
+    contexts = []
+    for render_at_scale in ('False', 'True'):
+        appContext = context.Context(config_path)
+        appContext.setConfig('Image', 'render_at_scale', render_at_scale)
+        contexts.append(appContext)
+    registry, _ = generator.load_assets(contexts[0], templates)
+
+    results = []
+    timings = [[], []]
+    for index in range(count):
+        plates = []
+        for appContext, samples in zip(contexts, timings):
+            start = time.perf_counter()
+            plates.append(render_plate(appContext, templates, registry, seed, index))
+            samples.append(time.perf_counter() - start)
+        results.append(compare_plates(plates[0], plates[1], tolerance))
+
+    return results, timings
+
+
+def print_results(results, timings):
+    print("{0:<16}{1:>10}{2:>10}{3:>10}{4:>10}".format('metric', 'mean', 'p99', 'min', 'max'))
+    for metric in METRICS:
+        values = np.array([result[metric] for result in results])
+        print("{0:<16}{1:>10.4f}{2:>10.4f}{3:>10.4f}{4:>10.4f}".format(metric,
+            values.mean(), np.percentile(values, 99), values.min(), values.max()))
+    for name, samples in zip(('full size', 'at scale'), timings):
+        print("render {0:<9} p50 {1:.3f} ms".format(name, np.percentile(samples, 50) * 1000))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures how far plates rendered at scale differ from plates rendered at full size and resized')
+    parser.add_argument('--config', default='configuration.cfg')
+    parser.add_argument('--templates', default='templates.json')
+    parser.add_argument('--plates', type=int, default=DEFAULT_PLATES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--tolerance', type=int, default=PIXEL_TOLERANCE, help='Pixel difference counted as a changed pixel')
+    parser.add_argument('--max-mean-diff', type=float, help='Fail if the mean pixel difference of any plate is larger')
+    parser.add_argument('--max-box-offset', type=float, help='Fail if any box edge moves more pixels')
+    args = parser.parse_args()
+
+    results, timings = validate(args.config, args.templates, args.plates, args.seed, args.tolerance)
+    print_results(results, timings)
+
+    failures = []
+    if args.max_mean_diff is not None and max(result['mean_abs_diff'] for result in results) > args.max_mean_diff:
+        failures.append('mean_abs_diff')
+    if args.max_box_offset is not None and max(result['box_offset'] for result in results) > args.max_box_offset:
+        failures.append('box_offset')
+    for metric in failures:
+        print("FAILED {0}: above the allowed maximum".format(metric))
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,281 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import os
+import io
+import csv
+import sys
+import json
+import time
+import struct
+import argparse
+
+import numpy as np
+import PIL.Image
+
+import context
+import shards
+import annotations
+
+# Bytes read to find the size of an image, JPEG frame headers written by OpenCV are well within them
+HEADER_SIZE = 1024
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+# JPEG start of frame markers, the ones holding the image size
+SOF_MARKERS = set(range(0xC0, 0xD0)).difference([0xC4, 0xC8, 0xCC])
+MAX_EXAMPLES = 5
+CHECKS = ['missing_files', 'unreadable_images', 'truncated_images', 'size_mismatches', 'duplicate_filenames',
+    'unannotated_images', 'degenerate_boxes', 'out_of_bounds_boxes']
+
+
+class FileImages(object):
+    """Images of a dataset saved as one file each"""
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.filenames = set(f for f in os.listdir(output_path) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+    def read_ends(self, filename):
+        """Returns the first HEADER_SIZE bytes and the last 2 bytes of an image"""
+        with open(os.path.join(self.output_path, filename), 'rb') as f:
+            header = f.read(HEADER_SIZE)
+            f.seek(max(0, os.fstat(f.fileno()).st_size - 2))
+            return header, f.read(2)
+
+
+    def close(self):
+        pass
+
+
+class ShardImages(object):
+    """Images of a dataset packed on tar shards, located by the index of each shard"""
+
+    def __init__(self, output_path):
+        self.entries = {}
+        self.shards = {}
+        for shard_path in shards.get_shard_paths(output_path):
+            for filename, image_offset, image_size, _, _ in shards.ShardReader(shard_path).entries:
+                self.entries[filename] = (shard_path, image_offset, image_size)
+        self.filenames = set(self.entries)
+
+
+    def read_ends(self, filename):
+        """Returns the first HEADER_SIZE bytes and the last 2 bytes of an image"""
+        shard_path, image_offset, image_size = self.entries[filename]
+        shard = self.shards.get(shard_path)
+        if shard is None:
+            shard = open(shard_path, 'rb')
+            self.shards[shard_path] = shard
+        shard.seek(image_offset)
+        header = shard.read(min(HEADER_SIZE, image_size))
+        shard.seek(image_offset + max(0, image_size - 2))
+        return header, shard.read(min(2, image_size))
+
+
+    def close(self):
+        for shard in self.shards.values():
+            shard.close()
+
+
+def get_jpeg_size(data):
+    """Returns (width, height) of a JPEG from the start of its data, None if no frame header is found"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    position = 2
+    while position + 4 <= len(data):
+        if data[position] != 0xFF:
+            return None
+        marker = data[position + 1]
+        if marker == 0xFF: # Fill byte
+            position += 1
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8: # Markers without a length
+            position += 2
+        elif marker in SOF_MARKERS:
+            if position + 9 > len(data):
+                return None
+            height, width = struct.unpack('>HH', data[position + 5:position + 9])
+            return width, height
+        else:
+            position += 2 + struct.unpack('>H', data[position + 2:position + 4])[0]
+    return None
+
+
+def get_image_size(header):
+    """Returns (width, height) of an image from its first bytes without decoding it, None if unreadable"""
+    size = get_jpeg_size(header)
+    if size is not None:
+        return size
+    try:
+        # PIL only parses the header on open
+        with PIL.Image.open(io.BytesIO(header)) as image:
+            return image.size
+    except (OSError, SyntaxError, ValueError):
+        return None
+
+
+def load_tf(path):
+    """Returns the columns of a TF .csv annotation file, a plate box per row, consecutive rows of a file are one image"""
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        rows = list(reader)
+    row_filenames = [row[0] for row in rows]
+    starts = [index for index, filename in enumerate(row_filenames) if index == 0 or filename != row_filenames[index - 1]]
+    values = np.array([row[1:3] + row[4:8] for row in rows], dtype=np.float64).reshape(-1, 6)
+    xmin, ymin, xmax, ymax = values[:, 2], values[:, 3], values[:, 4], values[:, 5]
+    boxes = np.stack([(xmin + xmax) / 2, (ymin + ymax) / 2, xmax - xmin, ymax - ymin, np.zeros(len(rows))], axis=1)
+    offsets = np.array(starts + [len(rows)], dtype=np.int64)
+    return [row_filenames[start] for start in starts], values[starts, 0], values[starts, 1], offsets, boxes
+
+
+def load_json(path):
+    """Returns the columns of a JSON Lines annotation file, image sizes are not annotated"""
+    filenames, counts, boxes = [], [], []
+    for annotation in annotations.JSONAnnotator().read_annotations(path):
+        # Images of several plates hold the boxes of each plate
+        plates = annotation.get('plates', [annotation])
+        image_bboxes = [bbox for plate_annotation in plates for bbox in plate_annotation['bboxes']]
+        filenames.append(annotation['filename'])
+        counts.append(len(image_bboxes))
+        boxes.extend([bbox['cx'], bbox['cy'], bbox['w'], bbox['h'], bbox['angle']] for bbox in image_bboxes)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    widths, heights = np.full(len(filenames), np.nan), np.full(len(filenames), np.nan)
+    return filenames, widths, heights, offsets, np.array(boxes, dtype=np.float64).reshape(-1, 5)
+
+
+def load_npz(path):
+    """Returns the columns of an .npz annotation file, boxes of every plate of an image together"""
+    columns = annotations.load_columns(path, mmap_mode='r')
+    boxes = np.stack([columns[column] for column in annotations.NPZAnnotator.BOX_COLUMNS], axis=1).astype(np.float64)
+    offsets = columns['offsets'][annotations.get_plate_offsets(columns)]
+    return columns['filename'].tolist(), columns['width'].astype(np.float64), columns['height'].astype(np.float64), offsets, boxes
+
+
+LOADERS = {'tf': load_tf, 'json': load_json, 'npz': load_npz}
+
+
+def check_boxes(boxes, offsets, widths, heights, tolerance=0.0):
+    """Returns degenerate and out of bounds masks of boxes, all boxes at once
+        Rotated boxes are checked by the extent of their corners
+    """
+    image_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    cx, cy, w, h, angle = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], np.deg2rad(boxes[:, 4])
+    degenerate = ~np.isfinite(boxes).all(axis=1) | (w <= 0) | (h <= 0)
+
+    extent_x = np.abs(w / 2 * np.cos(angle)) + np.abs(h / 2 * np.sin(angle))
+    extent_y = np.abs(w / 2 * np.sin(angle)) + np.abs(h / 2 * np.cos(angle))
+    with np.errstate(invalid='ignore'):
+        out_of_bounds = ((cx - extent_x < -tolerance) | (cy - extent_y < -tolerance) |
+            (cx + extent_x > widths[image_ids] + tolerance) | (cy + extent_y > heights[image_ids] + tolerance))
+    return degenerate, out_of_bounds & ~degenerate, image_ids
+
+
+def verify(annotation_file, annotation_type, output_path, output_format='files', tolerance=0.0):
+    """Checks a dataset against its annotations, returns a report with the count and examples of every problem found"""
+    start_time = time.time()
+    filenames, widths, heights, offsets, boxes = LOADERS[annotation_type](annotation_file)
+    images = ShardImages(output_path) if output_format == 'shards' else FileImages(output_path)
+    problems = dict((check, []) for check in CHECKS)
+
+    # Files on disk and their headers
+    seen = set()
+    for index, filename in enumerate(filenames):
+        if filename in seen:
+            problems['duplicate_filenames'].append(filename)
+            continue
+        seen.add(filename)
+        if filename not in images.filenames:
+            problems['missing_files'].append(filename)
+            continue
+        header, tail = images.read_ends(filename)
+        size = get_image_size(header)
+        if size is None:
+            problems['unreadable_images'].append(filename)
+            continue
+        if header[:2] == b'\xff\xd8' and tail != b'\xff\xd9':
+            problems['truncated_images'].append(filename)
+        if np.isnan(widths[index]):
+            widths[index], heights[index] = size
+        elif size != (widths[index], heights[index]):
+            problems['size_mismatches'].append(filename)
+    images.close()
+    problems['unannotated_images'] = sorted(images.filenames.difference(seen))
+
+    # Boxes of plates whose size is unknown are only checked for degenerate sizes
+    degenerate, out_of_bounds, image_ids = check_boxes(boxes, np.asarray(offsets), widths, heights, tolerance)
+    # Boxes are counted one by one, each image is listed once
+    problems['degenerate_boxes'] = [filenames[image_id] for image_id in image_ids[degenerate]]
+    problems['out_of_bounds_boxes'] = [filenames[image_id] for image_id in image_ids[out_of_bounds]]
+
+    report = {
+        'annotation_file': annotation_file,
+        'images': len(filenames),
+        'boxes': len(boxes),
+        'elapsed_s': time.time() - start_time
+    }
+    for check in CHECKS:
+        report[check] = len(problems[check])
+    report['examples'] = dict((check, get_examples(problems[check])) for check in CHECKS if problems[check])
+    return report
+
+
+def get_examples(filenames, count=MAX_EXAMPLES):
+    """Returns the first distinct file names of a problem"""
+    examples = []
+    for filename in filenames:
+        if filename not in examples:
+            examples.append(filename)
+            if len(examples) == count:
+                break
+    return examples
+
+
+def print_report(report):
+    print("Verified {0} images, {1} boxes of {2} in {3:.2f} s".format(report['images'], report['boxes'],
+        report['annotation_file'], report['elapsed_s']))
+    for check in CHECKS:
+        examples = report['examples'].get(check)
+        print("{0:<22}{1:>10}{2}".format(check, report[check], "  e.g. " + ", ".join(examples) if examples else ''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Verifies that every annotated plate has a readable image and boxes within it')
+    parser.add_argument('--config', default='configuration.cfg')
+    parser.add_argument('--output', help='Dataset directory, output_path by default')
+    parser.add_argument('--annotations', help='Annotation file, the one of this node on the dataset directory by default')
+    parser.add_argument('--tolerance', type=float, default=0.0, help='Pixels a box may extend past its image')
+    parser.add_argument('--report', help='Also write the report as JSON to this file')
+    args = parser.parse_args()
+
+    settings = context.Context(args.config).settings.general
+    output_path = args.output if args.output is not None else settings.output_path
+    annotation_file = args.annotations
+    if annotation_file is None:
+        annotator = annotations.AnnotatorFactory.get_annotator(settings.annotation_type)
+        annotator.shard_index, annotator.shard_count = settings.shard_index, settings.shard_count
+        annotation_file = annotator.get_output_file(output_path)
+
+    report = verify(annotation_file, settings.annotation_type, output_path, settings.output_format, args.tolerance)
+    print_report(report)
+    if args.report is not None:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=4)
+    if any(report[check] for check in CHECKS):
+        sys.exit(1)
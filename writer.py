@@ -0,0 +1,90 @@
+#######################################################################
+# Copyright (c) 2019 Alejandro Pereira
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>
+
+#######################################################################
+#!/usr/bin/python
+
+import queue
+import threading
+
+import utils
+import profiler
+
+
+class ImageWriter(object):
+    """Encodes and writes images on background threads
+        submit() blocks while the queue is full, failed writes are collected and reported by flush()
+    """
+
+    def __init__(self, threads=2, queue_size=64, run_profiler=None, fsync=False):
+        self.profiler = run_profiler if run_profiler is not None else profiler.DISABLED
+        self.fsync = fsync
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.failures = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self.run, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+
+    def submit(self, path, image):
+        """Queues an image to be written, written synchronously if there are no writer threads"""
+        if not self.threads:
+            self.write(path, image)
+        else:
+            self.queue.put((path, image))
+
+
+    def write(self, path, image):
+        try:
+            with self.profiler.stage('encode_write'):
+                written = utils.write_image(path, image, self.fsync)
+            self.profiler.count('bytes_written', written)
+        except Exception as error:
+            with self.lock:
+                self.failures.append((path, str(error)))
+
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            finally:
+                self.queue.task_done()
+
+
+    def flush(self):
+        """Waits until all queued images are written, returns and clears the list of (path, error) failures"""
+        self.queue.join()
+        with self.lock:
+            failures, self.failures = self.failures, []
+        return failures
+
+
+    def close(self):
+        """Writes pending images and stops writer threads, returns failed writes"""
+        failures = self.flush()
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        return failures